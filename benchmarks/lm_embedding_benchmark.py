@@ -0,0 +1,78 @@
+import time
+import torch
+from utils.config import *
+from utils.utils_general import _cuda
+from models.modules import ExternalKnowledge
+from utils.utils_testing import load_dataset
+
+'''
+Time per batch of adding the dialogue history encoder outputs to the memory
+in ExternalKnowledge.load_memory, forward and backward over -l hops: the
+per-sample loop it replaced, run twice per hop, against one gather through
+the lm_index built by collate_fn, added at every hop.
+
+Command:
+
+python -m benchmarks.lm_embedding_benchmark -ds=kvr -bsz=32 -hdd=128 -l=3
+
+'''
+
+
+def loop_add_lm_embedding(full_memory, kb_len, conv_len, hiddens):
+    """The add_lm_embedding that sliced every sample of the batch."""
+    for bi in range(full_memory.size(0)):
+        start, end = kb_len[bi], kb_len[bi]+conv_len[bi]
+        full_memory[bi, start:end, :] = full_memory[bi, start:end, :] + hiddens[bi, :conv_len[bi], :]
+    return full_memory
+
+
+def loop_memory(ext, embeds, batch, hiddens):
+    return [loop_add_lm_embedding(embed.clone(), batch['kb_arr_lengths'], batch['conv_arr_lengths'], hiddens)
+            for embed in embeds]
+
+
+def gather_memory(ext, embeds, batch, hiddens):
+    dh_memory = ext.lm_embedding(embeds[0].size(1), batch['kb_arr_lengths'], batch['conv_arr_lengths'],
+                                 hiddens, _cuda(batch['lm_index']))
+    return [embed + dh_memory for embed in embeds]
+
+
+def time_per_batch(add, ext, inputs, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for embeds, batch, hiddens in inputs:
+            memory = add(ext, embeds, batch, hiddens)
+            sum(m.sum() for m in memory).backward()
+        if USE_CUDA:
+            torch.cuda.synchronize()
+        best = min(best, (time.perf_counter() - start) / len(inputs))
+    return best
+
+
+if __name__ == "__main__":
+    batch_size = int(args['batch']) if args['batch'] else 32
+    hidden_size = int(args['hidden']) if args['hidden'] else 128
+    hops = int(args['layer']) if args['layer'] else 3
+    dataset = load_dataset(batch_size)
+    ext = ExternalKnowledge(dataset.vocab.n_words, hidden_size, hops, 0.0)
+    if USE_CUDA:
+        ext.cuda()
+
+    # embed_A and embed_C of every hop, and the history encoder outputs, of every batch
+    inputs = []
+    for i in range(0, len(dataset), batch_size):
+        batch = dataset.collate_fn(list(range(i, min(i+batch_size, len(dataset)))))
+        b, m = batch['context_arr'].size()[:2]
+        embeds = [_cuda(torch.randn(b, m, hidden_size)).requires_grad_() for _ in range(2*hops)]
+        hiddens = _cuda(torch.randn(b, batch['conv_arr'].size(0), hidden_size)).requires_grad_()
+        inputs.append((embeds, batch, hiddens))
+
+    for embeds, batch, hiddens in inputs:
+        for x, y in zip(loop_memory(ext, embeds, batch, hiddens), gather_memory(ext, embeds, batch, hiddens)):
+            assert torch.equal(x, y)
+    loop = time_per_batch(loop_memory, ext, inputs, 3)
+    gather = time_per_batch(gather_memory, ext, inputs, 3)
+    print("{} batches of {}, {} hops, hidden {}".format(len(inputs), batch_size, hops, hidden_size))
+    print("per-sample loop: {:.3f} ms/batch".format(loop*1000))
+    print("lm_index gather: {:.3f} ms/batch ({:.1f}x)".format(gather*1000, loop/gather))
@@ -0,0 +1,135 @@
+import os
+import sys
+import json
+import time
+import resource
+import tempfile
+import tracemalloc
+import importlib
+import subprocess
+from utils.config import *
+from utils.utils_general import Dataset, BucketBatchSampler, padding_efficiency
+from utils.utils_shard import DATASET_MODULES
+from utils.utils_testing import DEV_FILES, build_lang
+
+'''
+Throughput of every stage of the input pipeline on its own, on the dev split
+of a dataset: read_langs (parsing, without the cache), Lang building, Dataset
+encoding, Dataset.__getitem__, collate_fn over the batches of -bsz / -bk / -tb
+and, for kvr when tensorflow is installed, the TF gen_samples and
+from_generator path. Every stage reports samples/sec, and the peak memory it
+allocates itself, measured with tracemalloc on a second, untimed run of the
+stage (numpy and Python objects, not the buffers tensorflow allocates). The
+peak RSS of the whole process is reported once. The padding ratio is the
+share of padded memory rows in the collated batches.
+
+Without -ds, every dataset (bAbI tasks 1-5, kvr, multiwoz) is run in its own
+process, as MEM_TOKEN_SIZE depends on the dataset. -bj writes the results as
+JSON, to compare a pipeline change against a baseline.
+
+Command:
+
+python -m benchmarks.pipeline_benchmark -bsz=32 -bj=pipeline.json
+python -m benchmarks.pipeline_benchmark -ds=babi -t=5 -bsz=32 -bk=10
+
+'''
+
+RUNS = [('babi', str(task)) for task in range(1, 6)] + [('kvr', ''), ('multiwoz', '')]
+TF_FILE = 'data/KVR/dev.txt'
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def timed(stages, name, fn, n_samples=None):
+    """
+    Runs fn as stage name over n_samples samples and records its throughput, then runs it
+    again under tracemalloc for the peak memory it allocates. n_samples defaults to the number
+    of samples of the (pairs, max_resp_len) fn returns.
+    """
+    start = time.perf_counter()
+    result = fn()
+    seconds = time.perf_counter() - start
+    if n_samples is None:
+        n_samples = len(result[0])
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    stages[name] = {'seconds':seconds, 'samples_per_sec':n_samples / max(seconds, 1e-9),
+                    'peak_mb':peak / float(1 << 20)}
+    print("{:<12} {:>10.0f} samples/s  peak {:.1f} MB".format(name, stages[name]['samples_per_sec'],
+                                                             stages[name]['peak_mb']))
+    return result
+
+
+def tf_stages(stages, batch_size):
+    """The TF gen_samples / from_generator path of the kvr reader."""
+    try:
+        import utils.utils_tensorflow_Ent_kvr as tf_kvr
+    except ImportError as e:
+        print("tensorflow path skipped: {}".format(e))
+        stages['tf_gen_samples'] = stages['tf_from_generator'] = {'skipped':str(e)}
+        return
+    pairs, _ = tf_kvr.read_langs(TF_FILE)
+    seqs = tf_kvr.text_to_sequence(pairs, tf_kvr.build_lang(pairs, True))
+    timed(stages, 'tf_gen_samples', lambda: sum(1 for _ in tf_kvr.gen_samples(seqs, len(seqs))), len(seqs))
+    dataset = tf_kvr.get_seq(seqs, batch_size, drop_remainder=False)
+    timed(stages, 'tf_from_generator', lambda: sum(1 for _ in dataset), len(seqs))
+
+
+def run(batch_size):
+    module = importlib.import_module(DATASET_MODULES[args['dataset']])
+    file_name = DEV_FILES[args['dataset']].format(args['task'])
+    read_args = module.data_files(args['task'])[2]
+    stages = {}
+
+    pairs, _ = timed(stages, 'read_langs', lambda: module.read_langs(file_name, *read_args))
+    n = len(pairs)
+    lang = timed(stages, 'lang', lambda: build_lang(pairs), n)
+    data_info = dict((k, [pair[k] for pair in pairs]) for k in pairs[0].keys())
+    dataset = timed(stages, 'encode', lambda: Dataset(data_info, lang.freeze()), n)
+    timed(stages, 'getitem', lambda: [dataset[i] for i in range(n)], n)
+
+    lengths = dataset.lengths('context_arr')
+    batches = BucketBatchSampler(lengths, batch_size, args['buckets'], token_budget=args['token_budget']).batches()
+    timed(stages, 'collate', lambda: [dataset.collate_fn(batch.tolist()) for batch in batches], n)
+    if args['dataset'] == 'kvr':
+        tf_stages(stages, batch_size)
+
+    return {'dataset':args['dataset'], 'task':args['task'], 'file':file_name, 'n_samples':n,
+            'batch_size':batch_size, 'buckets':args['buckets'], 'token_budget':args['token_budget'],
+            'n_batches':len(batches), 'padding_ratio':1.0 - padding_efficiency(lengths, batches),
+            'stages':stages, 'peak_rss_mb':peak_rss_mb()}
+
+
+def run_all():
+    """Every dataset of RUNS benchmarked in a process of its own."""
+    results = []
+    for dataset, task in RUNS:
+        print("=== {} {}".format(dataset, task))
+        fd, out = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+        argv = ['-ds='+dataset, '-t='+task, '-bj='+out, '-bk={}'.format(args['buckets']),
+                '-tb={}'.format(args['token_budget'])]
+        if args['batch']:
+            argv.append('-bsz='+args['batch'])
+        subprocess.run([sys.executable, '-m', 'benchmarks.pipeline_benchmark'] + argv, check=True)
+        with open(out) as f:
+            results += json.load(f)
+        os.remove(out)
+    return results
+
+
+if __name__ == "__main__":
+    batch_size = int(args['batch']) if args['batch'] else 32
+    if args['dataset']:
+        results = [run(batch_size)]
+        print("padding ratio {:.3f} over {} batches, process peak RSS {:.0f} MB".format(
+            results[0]['padding_ratio'], results[0]['n_batches'], results[0]['peak_rss_mb']))
+    else:
+        results = run_all()
+    if args['bench_json']:
+        with open(args['bench_json'], 'w') as f:
+            json.dump(results, f, indent=1)
@@ -13,6 +13,7 @@ import json
 from utils.measures import wer, moses_multi_bleu
 from utils.masked_cross_entropy import *
 from utils.config import *
+from utils.utils_general import save_vocab, check_positions
 from models.modules_memory_using_kb_arr import *
 
 
@@ -43,6 +44,8 @@ class GLMP(nn.Module):
                 self.encoder = torch.load(str(path) + '/enc.th', lambda storage, loc: storage)
                 self.extKnow = torch.load(str(path) + '/enc_kb.th', lambda storage, loc: storage)
                 self.decoder = torch.load(str(path) + '/dec.th', lambda storage, loc: storage)
+            # the encoder of a -pos checkpoint carries its PositionEmbedding
+            check_positions(getattr(getattr(self.encoder, 'position', None), 'mode', 'token'), path)
         else:
             self.encoder = ContextRNN(lang.n_words, hidden_size, dropout)
             self.extKnow = ExternalKnowledge(lang.n_words, hidden_size, n_layers, dropout)
@@ -102,6 +105,7 @@ class GLMP(nn.Module):
         torch.save(self.encoder, directory + '/enc.th')
         torch.save(self.extKnow, directory + '/enc_kb.th')
         torch.save(self.decoder, directory + '/dec.th')
+        save_vocab(directory, self.lang, self.max_resp_len)
 
     def reset(self):
         self.loss, self.print_every, self.loss_g, self.loss_v, self.loss_l = 0, 1, 0, 0, 0
@@ -184,7 +188,7 @@ class GLMP(nn.Module):
             story, conv_story = data['kb_arr'], data['conv_arr']
 
         # Encode dialog history and KB to vectors
-        dh_outputs, dh_hidden = self.encoder(conv_story, data['conv_arr_lengths'])
+        dh_outputs, dh_hidden = self.encoder(conv_story, data['conv_arr_lengths'], positions=data.get('conv_arr_pos'))
         global_pointer, kb_readout = self.extKnow.load_memory(story, data['kb_arr_lengths'], data['conv_arr_lengths'],
                                                               dh_hidden, dh_outputs)
         # encoded_hidden = torch.cat((dh_hidden.squeeze(0), kb_readout), dim=1)
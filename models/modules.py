@@ -1,11 +1,49 @@
+import math
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from utils.config import *
-from utils.utils_general import _cuda
+from utils.utils_general import _cuda, lm_index
 import pdb
 
 
+def embed_cells(embedding, cells):
+    """
+    Sum of the embeddings of the tokens of every memory cell, [..., MEM_TOKEN_SIZE] -> [..., e],
+    as an embedding_bag that skips the PAD slots and never builds the [..., MEM_TOKEN_SIZE, e] tensor.
+    """
+    summed = F.embedding_bag(cells.reshape(-1, cells.size(-1)).long(), embedding.weight, mode='sum', padding_idx=PAD_token)
+    return summed.view(cells.size()[:-1] + (summed.size(-1),))
+
+
+def embed_hop_cells(weight, cells):
+    """
+    embed_cells with every table of a stacked hops+1 * V * e weight, [..., MEM_TOKEN_SIZE] ->
+    [hops+1, ..., e], in a single embedding_bag. The PAD slots of every hop index the PAD row
+    of the first table, so they are all skipped.
+    """
+    hops, vocab = weight.size(0), weight.size(1)
+    cells = cells.long()
+    offsets = torch.arange(hops, device=cells.device).view((hops,) + (1,) * cells.dim()) * vocab
+    index = torch.where(cells == PAD_token, cells, cells + offsets) # hops+1 * ... * s
+    summed = F.embedding_bag(index.reshape(-1, cells.size(-1)), weight.view(-1, weight.size(-1)),
+                             mode='sum', padding_idx=PAD_token)
+    return summed.view((hops,) + cells.size()[:-1] + (summed.size(-1),))
+
+
+def stack_hop_embeddings(module, state):
+    """
+    Restores an ExternalKnowledge pickled with one C_{hop} nn.Embedding per hop, like the
+    enc_kb.th of older checkpoints, with their weights stacked into hop_embedding.
+    """
+    nn.Module.__setstate__(module, state)
+    if "C_0" not in module._modules:
+        return
+    hops = [module._modules.pop("C_{}".format(hop)) for hop in range(module.max_hops+1)]
+    module.hop_embedding = nn.Parameter(torch.stack([C.weight.data for C in hops]))
+    module.__dict__.pop("C", None)
+
+
 class ContextRNN(nn.Module):
     def __init__(self, input_size, hidden_size, dropout, n_layers=1):
         super(ContextRNN, self).__init__()      
@@ -17,17 +55,18 @@ class ContextRNN(nn.Module):
         self.embedding = nn.Embedding(input_size, hidden_size, padding_idx=PAD_token)
         self.gru = nn.GRU(hidden_size, hidden_size, n_layers, dropout=dropout, bidirectional=True)
         self.W = nn.Linear(2*hidden_size, hidden_size)
+        self.position = PositionEmbedding(hidden_size, args['positions']) if args['positions'] != 'token' else None
 
     def get_state(self, bsz):
         """Get cell states and hidden states."""
         return _cuda(torch.zeros(2, bsz, self.hidden_size))
 
-    def forward(self, input_seqs, input_lengths, hidden=None):
+    def forward(self, input_seqs, input_lengths, hidden=None, positions=None):
         # Note: we run this all at once (over multiple batches of multiple sequences)
         # print("input_seqs in size: ", input_seqs.size())
-        embedded = self.embedding(input_seqs.contiguous().view(input_seqs.size(0), -1).long()) 
-        embedded = embedded.view(input_seqs.size()+(embedded.size(-1),))
-        embedded = torch.sum(embedded, 2).squeeze(2) 
+        embedded = embed_cells(self.embedding, input_seqs) # t * b * e
+        if getattr(self, 'position', None) is not None and positions is not None:
+            embedded = embedded + self.position(positions)
         embedded = self.dropout_layer(embedded)
         hidden = self.get_state(input_seqs.size(1))
         # print("input_seqs out size: ", input_seqs.size())
@@ -50,36 +89,54 @@ class ExternalKnowledge(nn.Module):
         self.embedding_dim = embedding_dim
         self.dropout = dropout
         self.dropout_layer = nn.Dropout(dropout) 
+        # the C embedding of every hop, stacked to be looked up at once
+        t = torch.randn(self.max_hops+1, vocab, embedding_dim) * 0.1
+        t[:, PAD_token, :] = 0
+        self.hop_embedding = nn.Parameter(t)
         for hop in range(self.max_hops+1):
-            C = nn.Embedding(vocab, embedding_dim, padding_idx=PAD_token)
-            # C.weight.data.normal_(0, 0.1)
-            t = torch.randn(vocab, embedding_dim) * 0.1
-            t[PAD_token, :] = torch.zeros(1, embedding_dim)
-            C.weight.data = t
-            self.add_module("C_{}".format(hop), C)
-        self.C = AttrProxy(self, "C_")
+            if args['positions'] != 'token':
+                self.add_module("P_{}".format(hop), PositionEmbedding(embedding_dim, args['positions']))
+        self.P = AttrProxy(self, "P_")
         self.softmax = nn.Softmax(dim=1)
         self.sigmoid = nn.Sigmoid()
         self.conv_layer = nn.Conv1d(embedding_dim, embedding_dim, 5, padding=2)
 
-    def add_lm_embedding(self, full_memory, kb_len, conv_len, hiddens):
-        for bi in range(full_memory.size(0)):
-            start, end = kb_len[bi], kb_len[bi]+conv_len[bi]
-            full_memory[bi, start:end, :] = full_memory[bi, start:end, :] + hiddens[bi, :conv_len[bi], :]
-        return full_memory
+    def __setstate__(self, state):
+        stack_hop_embeddings(self, state)
+
+    def lm_embedding(self, memory_len, kb_len, conv_len, hiddens, index=None):
+        """
+        The dialogue history encoder outputs hiddens (b * t * e) at their memory rows, zero
+        elsewhere (b * m * e), in one gather with the lm_index of the batch.
+        """
+        if index is None:
+            index = _cuda(lm_index(kb_len, conv_len, memory_len, hiddens.size(1)))
+        rows = torch.cat([hiddens.reshape(-1, hiddens.size(-1)), hiddens.new_zeros(1, hiddens.size(-1))])
+        return rows[index]
+
+    def add_lm_embedding(self, full_memory, kb_len, conv_len, hiddens, index=None):
+        return full_memory + self.lm_embedding(full_memory.size(1), kb_len, conv_len, hiddens, index)
 
-    def load_memory(self, story, kb_len, conv_len, hidden, dh_outputs):
+    def add_position_embedding(self, embed, hop, positions):
+        if positions is None or not hasattr(self, "P_{}".format(hop)):
+            return embed
+        return embed + self.P[hop](positions)
+
+    def load_memory(self, story, kb_len, conv_len, hidden, dh_outputs, positions=None, lm_index=None):
         # Forward multiple hop mechanism
         u = [hidden.squeeze(0)]
         story_size = story.size()
         self.m_story = []
+        if not args["ablationH"]:
+            # the same at every hop, gathered once
+            dh_memory = self.lm_embedding(story_size[1], kb_len, conv_len, dh_outputs, lm_index)
+        # all hops looked up at once, the embed_C of a hop is the embed_A of the next one
+        embeds = embed_hop_cells(self.hop_embedding, story) # (hops+1) * b * m * e
+        if not args["ablationH"]:
+            embeds = embeds + dh_memory
+        embeds = [self.add_position_embedding(embed, hop, positions) for hop, embed in enumerate(embeds)]
         for hop in range(self.max_hops):
-            embed_A = self.C[hop](story.contiguous().view(story_size[0], -1))#.long()) # b * (m * s) * e
-            embed_A = embed_A.view(story_size+(embed_A.size(-1),)) # b * m * s * e
-            embed_A = torch.sum(embed_A, 2).squeeze(2) # b * m * e
-            if not args["ablationH"]:
-                embed_A = self.add_lm_embedding(embed_A, kb_len, conv_len, dh_outputs)
-            embed_A = self.dropout_layer(embed_A)
+            embed_A = self.dropout_layer(embeds[hop])
             
             if(len(list(u[-1].size()))==1): 
                 u[-1] = u[-1].unsqueeze(0) ## used for bsz = 1.
@@ -87,12 +144,7 @@ class ExternalKnowledge(nn.Module):
             prob_logit = torch.sum(embed_A*u_temp, 2)
             prob_   = self.softmax(prob_logit)
             
-            embed_C = self.C[hop+1](story.contiguous().view(story_size[0], -1).long())
-            embed_C = embed_C.view(story_size+(embed_C.size(-1),)) 
-            embed_C = torch.sum(embed_C, 2).squeeze(2)
-            if not args["ablationH"]:
-                embed_C = self.add_lm_embedding(embed_C, kb_len, conv_len, dh_outputs)
-
+            embed_C = embeds[hop+1]
             prob = prob_.unsqueeze(2).expand_as(embed_C)
             o_k  = torch.sum(embed_C*prob, 1)
             u_k = u[-1] + o_k
@@ -101,27 +153,60 @@ class ExternalKnowledge(nn.Module):
         self.m_story.append(embed_C)
         return self.sigmoid(prob_logit), u[-1]
 
+    def prepare_memory(self, global_pointer):
+        """The memory of the last load_memory gated by global_pointer, for the reads of every decoding step."""
+        return PreparedMemory(self.m_story, None if args["ablationG"] else global_pointer)
+
     def forward(self, query_vector, global_pointer):
-        u = [query_vector]
-        for hop in range(self.max_hops):
-            m_A = self.m_story[hop] 
-            if not args["ablationG"]:
-                m_A = m_A * global_pointer.unsqueeze(2).expand_as(m_A) 
-            if(len(list(u[-1].size()))==1): 
-                u[-1] = u[-1].unsqueeze(0) ## used for bsz = 1.
-            u_temp = u[-1].unsqueeze(1).expand_as(m_A)
-            prob_logits = torch.sum(m_A*u_temp, 2)
-            prob_soft   = self.softmax(prob_logits)
-            m_C = self.m_story[hop+1] 
-            if not args["ablationG"]:
-                m_C = m_C * global_pointer.unsqueeze(2).expand_as(m_C)
-            prob = prob_soft.unsqueeze(2).expand_as(m_C)
-            o_k  = torch.sum(m_C*prob, 1)
-            u_k = u[-1] + o_k
-            u.append(u_k)
+        return self.prepare_memory(global_pointer).read(query_vector)
+
+
+class PreparedMemory(object):
+    """
+    The keys and values of every hop (m_story of ExternalKnowledge.load_memory, b * m * e each),
+    multiplied by the global pointer once per batch instead of at every decoding step.
+    """
+    def __init__(self, m_story, global_pointer=None):
+        if global_pointer is not None:
+            gate = global_pointer.unsqueeze(2)
+            m_story = [m * gate for m in m_story]
+        self.m_story = m_story
+
+    def read(self, query_vector):
+        """
+        The pointer distribution (softmax and logits) of the last hop for query_vector, b * e for
+        one decoding step or b * T * e for T steps at once, giving b * m or b * T * m.
+        """
+        u = query_vector
+        if(len(list(u.size()))==1):
+            u = u.unsqueeze(0) ## used for bsz = 1.
+        steps = u.dim() == 3
+        if not steps:
+            u = u.unsqueeze(1)
+        for hop in range(len(self.m_story)-1):
+            prob_logits = torch.bmm(u, self.m_story[hop].transpose(1, 2)) # b * T * m
+            prob_soft = F.softmax(prob_logits, dim=2)
+            u = u + torch.bmm(prob_soft, self.m_story[hop+1])
+        if not steps:
+            prob_soft, prob_logits = prob_soft.squeeze(1), prob_logits.squeeze(1)
         return prob_soft, prob_logits
 
 
+def teacher_forced_outputs(decoder, memory, hidden, target_batches, max_target_length):
+    """
+    The vocabulary and pointer logits (T * b * V and T * b * m) of the LocalMemoryDecoder decoder
+    fed with target_batches, from one sketch_rnn call over all the steps and batched reads of the
+    PreparedMemory memory, instead of a step at a time.
+    """
+    sos = target_batches.new_full((target_batches.size(0), 1), SOS_token)
+    decoder_input = torch.cat([sos, target_batches[:, :max_target_length-1]], 1).t() # T * b
+    embed_q = decoder.dropout_layer(decoder.C(decoder_input)) # T * b * e
+    outputs, _ = decoder.sketch_rnn(embed_q, hidden)
+    outputs_vocab = decoder.attend_vocab(decoder.C.weight, outputs)
+    _, prob_logits = memory.read(outputs.transpose(0, 1))
+    return outputs_vocab, prob_logits.transpose(0, 1)
+
+
 class LocalMemoryDecoder(nn.Module):
     def __init__(self, shared_emb, lang, embedding_dim, hop, dropout):
         super(LocalMemoryDecoder, self).__init__()
@@ -140,6 +225,13 @@ class LocalMemoryDecoder(nn.Module):
         self.softmax = nn.Softmax(dim = 1)
 
     def forward(self, extKnow, story_size, story_lengths, copy_list, encode_hidden, target_batches, max_target_length, batch_size, use_teacher_forcing, get_decoded_words, global_pointer):
+        hidden = self.relu(self.projector(encode_hidden)).unsqueeze(0)
+        memory = extKnow.prepare_memory(global_pointer)
+        if use_teacher_forcing and not get_decoded_words:
+            # every decoder input is known, all the steps at once
+            outputs_vocab, outputs_ptr = teacher_forced_outputs(self, memory, hidden, target_batches, max_target_length)
+            return outputs_vocab, outputs_ptr, [], []
+
         # Initialize variables for vocab and pointer
         all_decoder_outputs_vocab = _cuda(torch.zeros(max_target_length, batch_size, self.num_vocab))
         all_decoder_outputs_ptr = _cuda(torch.zeros(max_target_length, batch_size, story_size[1]))
@@ -147,7 +239,6 @@ class LocalMemoryDecoder(nn.Module):
         memory_mask_for_step = _cuda(torch.ones(story_size[0], story_size[1]))
         decoded_fine, decoded_coarse = [], []
         
-        hidden = self.relu(self.projector(encode_hidden)).unsqueeze(0)
 
         # Start to generate word-by-word
         for t in range(max_target_length):
@@ -162,7 +253,7 @@ class LocalMemoryDecoder(nn.Module):
             _, topvi = p_vocab.data.topk(1)
             
             # query the external konwledge using the hidden state of sketch RNN
-            prob_soft, prob_logits = extKnow(query_vector, global_pointer)
+            prob_soft, prob_logits = memory.read(query_vector)
             all_decoder_outputs_ptr[t] = prob_logits
 
             if use_teacher_forcing:
@@ -206,6 +297,41 @@ class LocalMemoryDecoder(nn.Module):
 
 
 
+class PositionEmbedding(nn.Module):
+    """
+    Embedding of the (turn, word) positions of memory rows ([..., 2] LongTensor, 0 for the rows
+    without a position), used instead of the 'turnN' and 'wordI' memory tokens with -pos.
+    learned sums a turn and a word embedding of max_position+1 rows each, larger positions
+    sharing the last one; sinusoidal encodes the turn in the first half of the dimensions and
+    the word in the second, without parameters.
+    """
+    def __init__(self, embedding_dim, mode, max_position=256):
+        super(PositionEmbedding, self).__init__()
+        self.embedding_dim = embedding_dim
+        self.mode = mode
+        self.max_position = max_position
+        if mode == 'learned':
+            self.turn = nn.Embedding(max_position+1, embedding_dim, padding_idx=0)
+            self.word = nn.Embedding(max_position+1, embedding_dim, padding_idx=0)
+            for embedding in [self.turn, self.word]:
+                embedding.weight.data.normal_(0, 0.1)
+                embedding.weight.data[0].zero_()
+
+    def sinusoid(self, positions, dim):
+        frequencies = torch.exp(torch.arange(0, dim, 2, device=positions.device).float() * (-math.log(10000.0) / dim))
+        angles = positions.unsqueeze(-1).float() * frequencies
+        encoding = torch.cat([torch.sin(angles), torch.cos(angles)], -1)[..., :dim]
+        return encoding * (positions > 0).unsqueeze(-1).float()
+
+    def forward(self, positions):
+        if self.mode == 'learned':
+            positions = positions.clamp(max=self.max_position)
+            return self.turn(positions[..., 0]) + self.word(positions[..., 1])
+        half = self.embedding_dim // 2
+        return torch.cat([self.sinusoid(positions[..., 0], self.embedding_dim - half),
+                          self.sinusoid(positions[..., 1], half)], -1)
+
+
 class AttrProxy(object):
     """
     Translates index lookups into attribute lookups.
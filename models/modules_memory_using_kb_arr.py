@@ -2,7 +2,9 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from utils.config import *
-from utils.utils_general import _cuda
+from utils.utils_general import _cuda, lm_index
+from models.modules import PositionEmbedding, embed_cells, embed_hop_cells, stack_hop_embeddings, PreparedMemory, \
+    teacher_forced_outputs
 import pdb
 
 
@@ -17,17 +19,18 @@ class ContextRNN(nn.Module):
         self.embedding = nn.Embedding(input_size, hidden_size, padding_idx=PAD_token)
         self.gru = nn.GRU(hidden_size, hidden_size, n_layers, dropout=dropout, bidirectional=True)
         self.W = nn.Linear(2 * hidden_size, hidden_size)
+        self.position = PositionEmbedding(hidden_size, args['positions']) if args['positions'] != 'token' else None
 
     def get_state(self, bsz):
         """Get cell states and hidden states."""
         return _cuda(torch.zeros(2, bsz, self.hidden_size))
 
-    def forward(self, input_seqs, input_lengths, hidden=None):
+    def forward(self, input_seqs, input_lengths, hidden=None, positions=None):
         # Note: we run this all at once (over multiple batches of multiple sequences)
         # print("input_seqs in size: ", input_seqs.size())
-        embedded = self.embedding(input_seqs.contiguous().view(input_seqs.size(0), -1).long())
-        embedded = embedded.view(input_seqs.size() + (embedded.size(-1),))
-        embedded = torch.sum(embedded, 2).squeeze(2)
+        embedded = embed_cells(self.embedding, input_seqs)  # t * b * e
+        if getattr(self, 'position', None) is not None and positions is not None:
+            embedded = embedded + self.position(positions)
         embedded = self.dropout_layer(embedded)
         hidden = self.get_state(input_seqs.size(1))
         # print("input_seqs out size: ", input_seqs.size())
@@ -50,23 +53,22 @@ class ExternalKnowledge(nn.Module):
         self.embedding_dim = embedding_dim
         self.dropout = dropout
         self.dropout_layer = nn.Dropout(dropout)
-        for hop in range(self.max_hops + 1):
-            C = nn.Embedding(vocab, embedding_dim, padding_idx=PAD_token)
-            # C.weight.data.normal_(0, 0.1)
-            t = torch.randn(vocab, embedding_dim) * 0.1
-            t[PAD_token, :] = torch.zeros(1, embedding_dim)
-            C.weight.data = t
-            self.add_module("C_{}".format(hop), C)
-        self.C = AttrProxy(self, "C_")
+        # the C embedding of every hop, stacked to be looked up at once
+        t = torch.randn(self.max_hops + 1, vocab, embedding_dim) * 0.1
+        t[:, PAD_token, :] = 0
+        self.hop_embedding = nn.Parameter(t)
         self.softmax = nn.Softmax(dim=1)
         self.sigmoid = nn.Sigmoid()
         self.conv_layer = nn.Conv1d(embedding_dim, embedding_dim, 5, padding=2)
 
-    def add_lm_embedding(self, full_memory, kb_len, conv_len, hiddens):
-        for bi in range(full_memory.size(0)):
-            start, end = kb_len[bi], kb_len[bi] + conv_len[bi]
-            full_memory[bi, start:end, :] = full_memory[bi, start:end, :] + hiddens[bi, :conv_len[bi], :]
-        return full_memory
+    def __setstate__(self, state):
+        stack_hop_embeddings(self, state)
+
+    def add_lm_embedding(self, full_memory, kb_len, conv_len, hiddens, index=None):
+        if index is None:
+            index = _cuda(lm_index(kb_len, conv_len, full_memory.size(1), hiddens.size(1)))
+        rows = torch.cat([hiddens.reshape(-1, hiddens.size(-1)), hiddens.new_zeros(1, hiddens.size(-1))])
+        return full_memory + rows[index]
 
     def load_memory(self, story, kb_len, conv_len, hidden, dh_outputs):
         # Forward multiple hop mechanism
@@ -74,11 +76,10 @@ class ExternalKnowledge(nn.Module):
         story = story.transpose(0, 1)
         story_size = story.size()
         self.m_story = []
+        # all hops looked up at once, the embed_C of a hop is the embed_A of the next one
+        embeds = embed_hop_cells(self.hop_embedding, story)  # (hops+1) * b * m * e
         for hop in range(self.max_hops):
-            embed_A = self.C[hop](story.contiguous().view(story_size[0], -1))  # .long()) # b * (m * s) * e
-            embed_A = embed_A.view(story_size + (embed_A.size(-1),))  # b * m * s * e
-            embed_A = torch.sum(embed_A, 2).squeeze(2)  # b * m * e
-            embed_A = self.dropout_layer(embed_A)
+            embed_A = self.dropout_layer(embeds[hop])
 
             if (len(list(u[-1].size())) == 1):
                 u[-1] = u[-1].unsqueeze(0)  ## used for bsz = 1.
@@ -86,9 +87,7 @@ class ExternalKnowledge(nn.Module):
             prob_logit = torch.sum(embed_A * u_temp, 2)
             prob_ = self.softmax(prob_logit)
 
-            embed_C = self.C[hop + 1](story.contiguous().view(story_size[0], -1).long())
-            embed_C = embed_C.view(story_size + (embed_C.size(-1),))
-            embed_C = torch.sum(embed_C, 2).squeeze(2)
+            embed_C = embeds[hop + 1]
 
             prob = prob_.unsqueeze(2).expand_as(embed_C)
             o_k = torch.sum(embed_C * prob, 1)
@@ -98,25 +97,11 @@ class ExternalKnowledge(nn.Module):
         self.m_story.append(embed_C)
         return self.sigmoid(prob_logit), u[-1]
 
+    def prepare_memory(self, global_pointer):
+        return PreparedMemory(self.m_story, None if args["ablationG"] else global_pointer)
+
     def forward(self, query_vector, global_pointer):
-        u = [query_vector]
-        for hop in range(self.max_hops):
-            m_A = self.m_story[hop]
-            if not args["ablationG"]:
-                m_A = m_A * global_pointer.unsqueeze(2).expand_as(m_A)
-            if (len(list(u[-1].size())) == 1):
-                u[-1] = u[-1].unsqueeze(0)  ## used for bsz = 1.
-            u_temp = u[-1].unsqueeze(1).expand_as(m_A)
-            prob_logits = torch.sum(m_A * u_temp, 2)
-            prob_soft = self.softmax(prob_logits)
-            m_C = self.m_story[hop + 1]
-            if not args["ablationG"]:
-                m_C = m_C * global_pointer.unsqueeze(2).expand_as(m_C)
-            prob = prob_soft.unsqueeze(2).expand_as(m_C)
-            o_k = torch.sum(m_C * prob, 1)
-            u_k = u[-1] + o_k
-            u.append(u_k)
-        return prob_soft, prob_logits
+        return self.prepare_memory(global_pointer).read(query_vector)
 
 
 class LocalMemoryDecoder(nn.Module):
@@ -138,6 +123,13 @@ class LocalMemoryDecoder(nn.Module):
 
     def forward(self, extKnow, story_size, story_lengths, copy_list, encode_hidden, target_batches, max_target_length,
                 batch_size, use_teacher_forcing, get_decoded_words, global_pointer):
+        hidden = self.relu(self.projector(encode_hidden)).unsqueeze(0)
+        memory = extKnow.prepare_memory(global_pointer)
+        if use_teacher_forcing and not get_decoded_words:
+            # every decoder input is known, all the steps at once
+            outputs_vocab, outputs_ptr = teacher_forced_outputs(self, memory, hidden, target_batches, max_target_length)
+            return outputs_vocab, outputs_ptr, [], []
+
         # Initialize variables for vocab and pointer
         all_decoder_outputs_vocab = _cuda(torch.zeros(max_target_length, batch_size, self.num_vocab))
         all_decoder_outputs_ptr = _cuda(torch.zeros(max_target_length, batch_size, story_size[1]))
@@ -145,7 +137,6 @@ class LocalMemoryDecoder(nn.Module):
         memory_mask_for_step = _cuda(torch.ones(story_size[0], story_size[1]))
         decoded_fine, decoded_coarse = [], []
 
-        hidden = self.relu(self.projector(encode_hidden)).unsqueeze(0)
 
         # Start to generate word-by-word
         for t in range(max_target_length):
@@ -160,7 +151,7 @@ class LocalMemoryDecoder(nn.Module):
             _, topvi = p_vocab.data.topk(1)
 
             # query the external konwledge using the hidden state of sketch RNN
-            prob_soft, prob_logits = extKnow(query_vector, global_pointer)
+            prob_soft, prob_logits = memory.read(query_vector)
             all_decoder_outputs_ptr[t] = prob_logits
 
             if use_teacher_forcing:
@@ -29,7 +29,12 @@ elif DS=='multiwoz':
 else:
     print("You need to provide the --dataset information")
 
-train, dev, test, testOOV, lang, max_resp_len = prepare_data_seq(task, batch_size=BSZ)
+# a checkpoint saved with its vocabulary only needs the evaluated splits
+lang, max_resp_len = load_vocab(args['path'])
+if lang is None:
+    train, dev, test, testOOV, lang, max_resp_len = prepare_data_seq(task, batch_size=BSZ)
+else:
+    test, testOOV = prepare_test_seq(task, lang, max_resp_len, batch_size=BSZ)
 
 model = globals()[decoder](
 	int(HDD), 
@@ -9,6 +9,10 @@ python myTest.py -ds= -path=
 
 '''
 
+if args['positions'] != 'token':
+    print("[ERROR] The TensorFlow models read positions only as memory tokens, run with -pos=token.")
+    exit(1)
+
 directory = args['path'].split("/")
 task = directory[2].split('HDD')[0]
 HDD = directory[2].split('HDD')[1].split('BSZ')[0]
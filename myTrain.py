@@ -9,6 +9,8 @@ Command:
 
 python myTrain.py -ds= -dec= -bsz= -t= -hdd= -dr= -l= -lr=
 
+Add -bk= to batch from context length buckets.
+
 '''
 
 early_stop = args['earlyStop']
@@ -51,6 +53,7 @@ for epoch in range(200):
         model.train_batch(data, int(args['clip']), reset=(i==0))
         pbar.set_description(model.print_loss())
         # break
+    print("Padding efficiency: {:.3f}".format(train.batch_sampler.efficiency))
     if((epoch+1) % int(args['evalp']) == 0):    
         acc = model.evaluate(dev, avg_best, early_stop)
         model.scheduler.step(acc)
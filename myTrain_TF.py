@@ -8,6 +8,10 @@ import os
 #os.environ["CUDA_VISIBLE_DEVICES"] = "-1"
 tf.compat.v1.enable_eager_execution()
 
+if args['positions'] != 'token':
+    print("[ERROR] The TensorFlow models read positions only as memory tokens, run with -pos=token.")
+    exit(1)
+
 early_stop = args['earlyStop']
 if args['dataset'] == 'kvr':
     from utils.utils_tensorflow_Ent_kvr import *
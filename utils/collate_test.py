@@ -0,0 +1,27 @@
+import sys
+sys.argv = sys.argv[:1] + ['-ds=kvr']  # utils.config parses the command line on import
+
+from utils.config import *
+from utils.utils_testing import load_dataset, loop_collate, assert_same_batch
+
+'''
+Dataset.collate_fn pads every batch of the KVR dev split, encoded with its own
+vocabulary, to the same tensors and lists as the per-sample loop it replaced.
+
+Command:
+
+python -m pytest utils/collate_test.py
+
+'''
+
+
+def test_collate_parity():
+    dataset = load_dataset(32)
+    assert dataset.vocab.n_words > 100
+    for start in range(0, len(dataset), 32):
+        batch = list(range(start, min(start+32, len(dataset))))
+        assert_same_batch(loop_collate([dataset[i] for i in batch]), dataset.collate_fn(batch))
+
+
+if __name__=="__main__":
+    test_collate_parity()
@@ -28,7 +28,8 @@ parser.add_argument('-path','--path', help='path of the file to load', required=
 parser.add_argument('-clip','--clip', help='gradient clipping', required=False, default=10)
 parser.add_argument('-tfr','--teacher_forcing_ratio', help='teacher_forcing_ratio', type=float, required=False, default=0.5)
 
-parser.add_argument('-sample','--sample', help='Number of Samples', required=False,default=None)
+parser.add_argument('-sample','--sample', help='Number of dialogues drawn from every data file, all of them by default', type=int, required=False,default=None)
+parser.add_argument('-ss','--sample_seed', help='seed of the -sample draw and of utils.utils_synthetic', type=int, required=False, default=0)
 parser.add_argument('-evalp','--evalp', help='evaluation period', required=False, default=1)
 parser.add_argument('-an','--addName', help='An add name for the save folder', required=False, default='')
 parser.add_argument('-gs','--genSample', help='Generate Sample', required=False, default=0)
@@ -36,6 +37,25 @@ parser.add_argument('-es','--earlyStop', help='Early Stop Criteria, BLEU or ENTF
 parser.add_argument('-abg','--ablationG', help='ablation global memory pointer', type=int, required=False, default=0)
 parser.add_argument('-abh','--ablationH', help='ablation context embedding', type=int, required=False, default=0)
 parser.add_argument('-rec','--record', help='use record function during inference', type=int, required=False, default=0)
+parser.add_argument('-cache','--cache', help='use the on-disk cache of parsed datasets', type=int, required=False, default=1)
+parser.add_argument('-bk','--buckets', help='number of context length buckets to batch from, 0 keeps the file order', type=int, required=False, default=0)
+parser.add_argument('-tb','--token_budget', help='batch by a budget on batch size x memory length x MEM_TOKEN_SIZE instead of -bsz, 0 disables it', type=int, required=False, default=0)
+parser.add_argument('-nw','--num_workers', help='number of DataLoader worker processes assembling batches', type=int, required=False, default=0)
+parser.add_argument('-pp','--parse_proc', help='number of processes parsing the dataset files', type=int, required=False, default=1)
+parser.add_argument('-raw','--raw_json', help='read the KVR splits from the raw kvret_*_public.json files of -rd instead of the converted text files', type=int, required=False, default=0)
+parser.add_argument('-rd','--raw_dir', help='directory of the kvret_{train,dev,test}_public.json files of the KVRET release read with -raw', required=False, default='data/KVR')
+parser.add_argument('-pos','--positions', help='turn/word positions of the dialogue history as memory tokens, or as learned or sinusoidal embeddings (PyTorch models only)', required=False, default='token', choices=['token', 'learned', 'sinusoidal'])
+parser.add_argument('-sd','--shard_dir', help='directory of the train split shards written by utils.utils_shard', required=False, default=None)
+parser.add_argument('-ns','--n_shards', help='number of shards utils.utils_shard writes', type=int, required=False, default=1)
+parser.add_argument('-rank','--rank', help='rank of this process, reading the shards rank, rank+world, ...', type=int, required=False, default=int(os.environ.get('RANK', 0)))
+parser.add_argument('-world','--world', help='number of processes sharing the shards', type=int, required=False, default=int(os.environ.get('WORLD_SIZE', 1)))
+parser.add_argument('-gd','--gen_dialogues', help='number of dialogues utils.utils_synthetic writes', type=int, required=False, default=100)
+parser.add_argument('-gt','--gen_turns', help='turns per synthetic dialogue', type=int, required=False, default=5)
+parser.add_argument('-gk','--gen_kb_rows', help='KB rows per synthetic dialogue', type=int, required=False, default=50)
+parser.add_argument('-gv','--gen_vocab', help='number of synthetic non-entity words', type=int, required=False, default=1000)
+parser.add_argument('-ge','--gen_entity_density', help='probability of a synthetic word being an entity', type=float, required=False, default=0.2)
+parser.add_argument('-go','--gen_out', help='file utils.utils_synthetic writes', required=False, default=None)
+parser.add_argument('-bj','--bench_json', help='file the benchmarks write their JSON results to', required=False, default=None)
 # parser.add_argument('-beam','--beam_search', help='use beam_search during inference, default is greedy search', type=int, required=False, default=0)
 # parser.add_argument('-viz','--vizualization', help='vizualization', type=int, required=False, default=0)
 
@@ -45,6 +65,7 @@ print("USE_CUDA: "+str(USE_CUDA))
 
 LIMIT = int(args["limit"]) 
 MEM_TOKEN_SIZE = 6 if args["dataset"] == 'kvr' else 4
+CACHE_DIR = 'data/cache'
 
 if args["ablationG"]: args["addName"] += "ABG"
 if args["ablationH"]: args["addName"] += "ABH"
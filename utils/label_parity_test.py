@@ -0,0 +1,71 @@
+import sys
+sys.argv = sys.argv[:1] + ['-ds=kvr']  # utils.config parses the command line on import
+
+from utils.config import *
+import utils.utils_Ent_kvr as kvr
+import utils.utils_Ent_babi as babi
+import utils.utils_Ent_multiwoz_new as multiwoz
+import utils.utils_Ent_multiwoz_new_memory_using_kb_arr as multiwoz_kb
+from utils.utils_entity import get_babi_index
+
+'''
+Parity of the local pointer (ptr_index) and global selector (selector_index) labels
+built with LastPosition against the original full scans over the memory.
+
+Command:
+
+python -m pytest utils/label_parity_test.py
+
+'''
+
+
+def reference_labels(memory, response, ent_index):
+    ptr_index = []
+    for key in response.split():
+        index = [loc for loc, val in enumerate(memory) if (val[0] == key and key in ent_index)]
+        if (index):
+            index = max(index)
+        else:
+            index = len(memory)
+        ptr_index.append(index)
+    selector_index = [1 if (word_arr[0] in ent_index or word_arr[0] in response.split()) else 0 for word_arr in memory] + [1]
+    return ptr_index + [len(memory)], selector_index
+
+
+def check_context_labels(pairs):
+    for pair in pairs:
+        context_arr = pair['context_arr'][:-1] # drop the NULL token
+        ptr_index, selector_index = reference_labels(context_arr, pair['response'], pair['ent_index'])
+        assert pair['ptr_index'] == ptr_index, pair['ID']
+        assert pair['selector_index'] == selector_index, pair['ID']
+
+
+def test_kvr():
+    pairs, _ = kvr.read_langs('data/KVR/dev_modified.txt')
+    check_context_labels(pairs)
+
+
+def test_babi():
+    pairs, _ = babi.read_langs('data/dialog-bAbI-tasks/dialog-babi-task5dev.txt', get_babi_index(5), max_line=100)
+    check_context_labels(pairs)
+
+
+def test_multiwoz():
+    pairs, _ = multiwoz.read_langs('data/multiwoz/valid_modified.txt')
+    check_context_labels(pairs)
+
+
+def test_multiwoz_kb_arr():
+    pairs, _ = multiwoz_kb.read_langs('data/multiwoz/valid_modified.txt')
+    for pair in pairs:
+        kb_arr = pair['kb_arr'][:-1] # drop the NULL token
+        ptr_index, _ = reference_labels(kb_arr, pair['response'], pair['ent_index'])
+        assert pair['ptr_index'] == ptr_index, pair['ID']
+        assert pair['selector_index'] == [1 if triple[0] in pair['ent_index'] else 0 for triple in kb_arr] + [1], pair['ID']
+
+
+if __name__=="__main__":
+    test_kvr()
+    test_babi()
+    test_multiwoz()
+    test_multiwoz_kb_arr()
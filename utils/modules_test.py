@@ -0,0 +1,114 @@
+import sys
+sys.argv = sys.argv[:1] + ['-ds=kvr']  # utils.config parses the command line on import
+
+import io
+from collections import OrderedDict
+from utils.config import *
+import torch
+import torch.nn as nn
+from models.modules import ExternalKnowledge, LocalMemoryDecoder, AttrProxy, PreparedMemory, embed_cells, embed_hop_cells
+from utils.utils_general import Lang
+
+'''
+The stacked hop_embedding of ExternalKnowledge looks every hop up in one
+embedding_bag, like a separate embed_cells per C_{hop} table, and an
+ExternalKnowledge pickled with one C_{hop} nn.Embedding per hop, like the
+enc_kb.th of older checkpoints, loads with its weights stacked. The
+PreparedMemory reads of the decoder match gating the memory at every step,
+and the teacher-forced outputs of all steps at once match the step loop.
+
+Command:
+
+python -m pytest utils/modules_test.py
+
+'''
+
+
+def memory(b, m, vocab):
+    story = torch.randint(0, vocab, (b, m, MEM_TOKEN_SIZE))
+    story[:, :, 3:] = PAD_token
+    return story
+
+
+def per_hop_pickle(ext):
+    """ext as older checkpoints pickled it, with a C_{hop} nn.Embedding per hop."""
+    state = dict(ext.__dict__)
+    state['_parameters'] = OrderedDict((k, v) for k, v in ext._parameters.items() if k != 'hop_embedding')
+    state['_modules'] = OrderedDict(ext._modules)
+    for hop, weight in enumerate(ext.hop_embedding.data):
+        C = nn.Embedding(weight.size(0), weight.size(1), padding_idx=PAD_token)
+        C.weight.data = weight.clone()
+        state['_modules']["C_{}".format(hop)] = C
+    old = ExternalKnowledge.__new__(ExternalKnowledge)
+    nn.Module.__setstate__(old, state)
+    old.C = AttrProxy(old, "C_")
+    buf = io.BytesIO()
+    torch.save(old, buf)
+    buf.seek(0)
+    return buf
+
+
+def test_hop_embedding():
+    ext = ExternalKnowledge(40, 8, 3, 0.0)
+    ext.train(False)
+    story = memory(2, 7, 40)
+    embeds = embed_hop_cells(ext.hop_embedding, story)
+    for hop in range(4):
+        C = nn.Embedding.from_pretrained(ext.hop_embedding[hop].detach())
+        assert torch.allclose(embeds[hop], embed_cells(C, story), atol=1e-6)
+
+    loaded = torch.load(per_hop_pickle(ext), weights_only=False)
+    assert [name for name, _ in loaded.named_parameters()] == [name for name, _ in ext.named_parameters()]
+    assert torch.equal(loaded.hop_embedding, ext.hop_embedding)
+    hidden, dh_outputs = torch.randn(1, 2, 8), torch.randn(2, 4, 8)
+    for x, y in zip(ext.load_memory(story, [2, 3], [4, 3], hidden, dh_outputs),
+                    loaded.load_memory(story, [2, 3], [4, 3], hidden, dh_outputs)):
+        assert torch.equal(x, y)
+
+
+def gated_read(m_story, query_vector, global_pointer):
+    """The pointer read of ExternalKnowledge.forward before PreparedMemory."""
+    u = [query_vector]
+    for hop in range(len(m_story)-1):
+        m_A = m_story[hop] * global_pointer.unsqueeze(2).expand_as(m_story[hop])
+        prob_logits = torch.sum(m_A*u[-1].unsqueeze(1).expand_as(m_A), 2)
+        prob_soft = torch.softmax(prob_logits, 1)
+        m_C = m_story[hop+1] * global_pointer.unsqueeze(2).expand_as(m_story[hop+1])
+        u.append(u[-1] + torch.sum(m_C*prob_soft.unsqueeze(2).expand_as(m_C), 1))
+    return prob_soft, prob_logits
+
+
+def test_prepared_memory():
+    m_story = [torch.randn(3, 9, 8) for _ in range(4)]
+    global_pointer = torch.rand(3, 9)
+    memory = PreparedMemory(m_story, global_pointer)
+    for _ in range(5):
+        query_vector = torch.randn(3, 8)
+        for x, y in zip(memory.read(query_vector), gated_read(m_story, query_vector, global_pointer)):
+            assert torch.allclose(x, y, atol=1e-5)
+    prob_soft, _ = PreparedMemory([m[:1] for m in m_story], global_pointer[:1]).read(torch.randn(8))
+    assert prob_soft.size() == (1, 9)
+
+
+def test_teacher_forcing():
+    lang = Lang()
+    lang.index_words(' '.join('w{}'.format(i) for i in range(30)), trg=True)
+    ext = ExternalKnowledge(lang.n_words, 8, 3, 0.0)
+    decoder = LocalMemoryDecoder(nn.Embedding(lang.n_words, 8, padding_idx=PAD_token), lang, 8, 3, 0.0)
+    story = memory(2, 7, lang.n_words)
+    ext.load_memory(story, [2, 3], [4, 3], torch.randn(1, 2, 8), torch.randn(2, 4, 8))
+    target = torch.randint(4, lang.n_words, (2, 6))
+    copy_list = [['w{}'.format(i) for i in range(7)]] * 2
+    inputs = (ext, story.size(), [7, 6], copy_list, torch.randn(2, 16), target, 6, 2, True)
+    global_pointer = torch.rand(2, 7)
+    parallel = decoder(*inputs + (False, global_pointer))
+    loop = decoder(*inputs + (True, global_pointer))
+    for x, y in zip(parallel[:2], loop[:2]):
+        assert x.size() == y.size()
+        assert torch.allclose(x, y, atol=1e-5)
+
+
+if __name__=="__main__":
+    test_hop_embedding()
+    test_prepared_memory()
+    test_teacher_forcing()
@@ -6,14 +6,18 @@ from utils.config import *
 import ast
 
 from utils.utils_general import *
-from utils.utils_temp import entityList, get_type_dict
+from utils.utils_cache import read_langs_cached, lazy_splits
+from utils.utils_shard import train_splits
+from utils.utils_dialogue import open_dialogues, DialogueMemory
+from utils.utils_entity import get_babi_index, babi_kb, ENTITY_FILES
 
 
-def read_langs(file_name, global_entity, type_dict, max_line = None):
+def read_langs(file_name, kb_index, max_line = None):
     # print(("Reading lines from {}".format(file_name)))
-    data, context_arr, conv_arr, kb_arr = [], [], [], []
+    data, memory = [], DialogueMemory()
+    positions = LastPosition()
     max_resp_len, sample_counter = 0, 0
-    with open(file_name) as fin:
+    with open_dialogues(file_name) as fin:
         cnt_lin = 1
         for line in fin:
             line = line.strip()
@@ -23,54 +27,55 @@ def read_langs(file_name, global_entity, type_dict, max_line = None):
                 if '\t' in line:
                     u, r = line.split('\t')
                     gen_u = generate_memory(u, "$u", str(nid)) 
-                    context_arr += gen_u
-                    conv_arr += gen_u
+                    positions.add_back(gen_u)
+                    memory.add_conv(gen_u)
                     ptr_index, ent_words = [], []
                     
                     # Get local pointer position for each word in system response
                     for key in r.split():
-                        if key in global_entity and key not in ent_words: 
+                        if key in kb_index and key not in ent_words: 
                             ent_words.append(key)
-                        index = [loc for loc, val in enumerate(context_arr) if (val[0] == key and key in global_entity)]
-                        index = max(index) if (index) else len(context_arr)
-                        ptr_index.append(index)
+                        index = positions.get(key) if key in kb_index else None
+                        ptr_index.append(len(positions) if index is None else index)
                     
                     # Get global pointer labels for words in system response, the 1 in the end is for the NULL token
-                    selector_index = [1 if (word_arr[0] in ent_words or word_arr[0] in r.split()) else 0 for word_arr in context_arr] + [1]
+                    selected = set(ent_words) | set(r.split())
+                    selector_index = [1 if word_arr[0] in selected else 0 for word_arr in memory.context_arr(null=False)] + [1]
                     
-                    sketch_response = generate_template(global_entity, r, type_dict)
+                    sketch_response = generate_template(kb_index, r)
                     
                     data_detail = {
-                        'context_arr':list(context_arr+[['$$$$']*MEM_TOKEN_SIZE]), # $$$$ is NULL token
+                        'context_arr':memory.context_arr(),
                         'response':r,
                         'sketch_response':sketch_response,
-                        'ptr_index':ptr_index+[len(context_arr)],
+                        'ptr_index':ptr_index+[len(positions)],
                         'selector_index':selector_index,
                         'ent_index':ent_words,
                         'ent_idx_cal':[],
                         'ent_idx_nav':[],
                         'ent_idx_wet':[],
-                        'conv_arr':list(conv_arr),
-                        'kb_arr':list(kb_arr), 
+                        'conv_arr':memory.conv_arr(),
+                        'kb_arr':memory.kb_arr(), 
                         'id':int(sample_counter),
                         'ID':int(cnt_lin),
                         'domain':""}
                     data.append(data_detail)
 
                     gen_r = generate_memory(r, "$s", str(nid)) 
-                    context_arr += gen_r
-                    conv_arr += gen_r
+                    positions.add_back(gen_r)
+                    memory.add_conv(gen_r)
                     if max_resp_len < len(r.split()):
                         max_resp_len = len(r.split())
                     sample_counter += 1
                 else:
                     r = line
                     kb_info = generate_memory(r, "", str(nid))
-                    context_arr = kb_info + context_arr
-                    kb_arr += kb_info
+                    positions.add_front(kb_info)
+                    memory.add_kb(kb_info)
             else:
                 cnt_lin += 1
-                context_arr, conv_arr, kb_arr = [], [], []
+                memory = DialogueMemory()
+                positions = LastPosition()
                 if(max_line and cnt_lin>=max_line):
                     break
 
@@ -93,15 +98,11 @@ def generate_memory(sent, speaker, time):
     return sent_new
 
 
-def generate_template(global_entity, sentence, type_dict):
+def generate_template(kb_index, sentence):
     sketch_response = []
     for word in sentence.split():
-        if word in global_entity:
-            ent_type = None
-            for kb_item in type_dict.keys():
-                if word in type_dict[kb_item]:
-                    ent_type = kb_item
-                    break
+        ent_type = kb_index.get(word)
+        if ent_type is not None:
             sketch_response.append('@'+ent_type)
         else:
             sketch_response.append(word)
@@ -109,44 +110,52 @@ def generate_template(global_entity, sentence, type_dict):
     return sketch_response
 
 
-def prepare_data_seq(task, batch_size=100):
+def data_files(task):
+    """The data file of every split, the files read_langs depends on and its extra arguments."""
     data_path = 'data/dialog-bAbI-tasks/dialog-babi'
-    file_train = '{}-task{}trn.txt'.format(data_path, task)
-    file_dev = '{}-task{}dev.txt'.format(data_path, task)
-    file_test = '{}-task{}tst.txt'.format(data_path, task)
-    kb_path = data_path+'-kb-all.txt'
-    file_test_OOV = '{}-task{}tst-OOV.txt'.format(data_path, task)
-    type_dict = get_type_dict(kb_path, dstc2=False)
-    global_ent = entityList('data/dialog-bAbI-tasks/dialog-babi-kb-all.txt',int(task))
-
-    pair_train, train_max_len = read_langs(file_train, global_ent, type_dict)
-    pair_dev, dev_max_len = read_langs(file_dev, global_ent, type_dict)
-    pair_test, test_max_len = read_langs(file_test, global_ent, type_dict)
-    pair_testoov, testoov_max_len = read_langs(file_test_OOV, global_ent, type_dict)
-    max_resp_len = max(train_max_len, dev_max_len, test_max_len, testoov_max_len) + 1
+    files = {'train': '{}-task{}trn.txt'.format(data_path, task),
+             'dev': '{}-task{}dev.txt'.format(data_path, task),
+             'test': '{}-task{}tst.txt'.format(data_path, task),
+             'testOOV': '{}-task{}tst-OOV.txt'.format(data_path, task)}
+    # the KB the entity index of the task is built from
+    return files, [ENTITY_FILES[babi_kb(task)]], (get_babi_index(task),)
+
+def prepare_data_seq(task, batch_size=100):
+    files, deps, read_args = data_files(task)
+    splits = train_splits(read_langs, [files['train'], files['dev'], files['test'], files['testOOV']], deps, *read_args)
+    split_train, split_dev, split_test, split_testoov = splits
+    # the other splits are only read when a model is evaluated on them
+    max_resp_len = split_train.max_resp_len + 1
     
-    lang = Lang()
+    lang = split_train.vocab if args['shard_dir'] else Lang()
 
-    train = get_seq(pair_train, lang, batch_size, True)
-    dev   = get_seq(pair_dev, lang, 100, False)
-    test  = get_seq(pair_test, lang, batch_size, False)
-    testoov = get_seq(pair_testoov, lang, batch_size, False)
+    train = get_seq(split_train.pairs(), lang, batch_size, True)
+    lang = lang.freeze()
+    dev   = LazyLoader(split_dev, lang, 100)
+    test  = LazyLoader(split_test, lang, batch_size)
+    testoov = LazyLoader(split_testoov, lang, batch_size)
 
-    print("Read %s sentence pairs train" % len(pair_train))
-    print("Read %s sentence pairs dev" % len(pair_dev))
-    print("Read %s sentence pairs test" % len(pair_test))  
+    print("Read %s sentence pairs train" % split_train.n_samples)
     print("Vocab_size: %s " % lang.n_words)
     print("Max. length of system response: %s " % max_resp_len)
     print("USE_CUDA={}".format(USE_CUDA))
 
     return train, dev, test, testoov, lang, max_resp_len
 
+def prepare_test_seq(task, lang, max_resp_len, batch_size=100):
+    """Test and OOV test splits only, for a model whose vocabulary comes from load_vocab."""
+    files, deps, read_args = data_files(task)
+    split_test, split_testoov = lazy_splits(read_langs, [files['test'], files['testOOV']], deps, *read_args)
+    test = LazyLoader(split_test, lang, batch_size)
+    testoov = LazyLoader(split_testoov, lang, batch_size)
+
+    print("Vocab_size: %s " % lang.n_words)
+    print("USE_CUDA={}".format(USE_CUDA))
+
+    return test, testoov
+
 def get_data_seq(file_name, lang, max_len, task=5, batch_size=1):
-    data_path = 'data/dialog-bAbI-tasks/dialog-babi'
-    kb_path = data_path+'-kb-all.txt'
-    type_dict = get_type_dict(kb_path, dstc2=False)
-    global_ent = entityList(kb_path, int(task))
-    pair, _ = read_langs(file_name, global_ent, type_dict)
+    pair, _ = read_langs_cached(read_langs, file_name, [ENTITY_FILES[babi_kb(task)]], get_babi_index(task))
     # print("pair", pair)
     d = get_seq(pair, lang, batch_size, False)
     return d
@@ -2,17 +2,22 @@ import json
 import ast
 
 from utils.utils_general import *
+from utils.utils_cache import read_langs_cached, lazy_splits
+from utils.utils_shard import train_splits
+from utils.utils_dialogue import open_dialogues, DialogueMemory, DialogueSample
+from utils.utils_entity import get_entity_index
 
 
 def read_langs(file_name, max_line = None):
-    print(("Reading lines from {}".format(file_name)))
-    data, context_arr, conv_arr, kb_arr = [], [], [], []
+    if not isinstance(file_name, DialogueSample): # single dialogues are read quietly
+        print(("Reading lines from {}".format(file_name)))
+    data, memory = [], DialogueMemory()
+    positions = LastPosition()
     max_resp_len = 0
     
-    with open('data/KVR/kvret_entities.json') as f:
-        global_entity = json.load(f)
+    global_entity = get_entity_index('kvr')
     
-    with open(file_name) as fin:
+    with open_dialogues(file_name) as fin:
         cnt_lin, sample_counter = 1, 1
         for line in fin:
             line = line.strip()
@@ -26,8 +31,8 @@ def read_langs(file_name, max_line = None):
                 if '\t' in line:
                     u, r, gold_ent = line.split('\t')
                     gen_u = generate_memory(u, "$u", str(nid)) 
-                    context_arr += gen_u
-                    conv_arr += gen_u
+                    positions.add_back(gen_u)
+                    memory.add_conv(gen_u)
                     
                     # Get gold entity for each domain
                     gold_ent = ast.literal_eval(gold_ent)
@@ -40,49 +45,47 @@ def read_langs(file_name, max_line = None):
                     # Get local pointer position for each word in system response
                     ptr_index = []
                     for key in r.split():
-                        index = [loc for loc, val in enumerate(context_arr) if (val[0] == key and key in ent_index)]
-                        if (index):
-                            index = max(index) 
-                        else: 
-                            index = len(context_arr)
-                        ptr_index.append(index)
+                        index = positions.get(key) if key in ent_index else None
+                        ptr_index.append(len(positions) if index is None else index)
 
                     # Get global pointer labels for words in system response, the 1 in the end is for the NULL token
-                    selector_index = [1 if (word_arr[0] in ent_index or word_arr[0] in r.split()) else 0 for word_arr in context_arr] + [1]
+                    selected = set(ent_index) | set(r.split())
+                    selector_index = [1 if word_arr[0] in selected else 0 for word_arr in memory.context_arr(null=False)] + [1]
                     
-                    sketch_response = generate_template(global_entity, r, gold_ent, kb_arr, task_type)
+                    sketch_response = generate_template(global_entity, r, gold_ent, memory.kb, task_type)
                     
                     data_detail = {
-                        'context_arr':list(context_arr+[['$$$$']*MEM_TOKEN_SIZE]), # $$$$ is NULL token
+                        'context_arr':memory.context_arr(),
                         'response':r,
                         'sketch_response':sketch_response,
-                        'ptr_index':ptr_index+[len(context_arr)],
+                        'ptr_index':ptr_index+[len(positions)],
                         'selector_index':selector_index,
                         'ent_index':ent_index,
                         'ent_idx_cal':list(set(ent_idx_cal)),
                         'ent_idx_nav':list(set(ent_idx_nav)),
                         'ent_idx_wet':list(set(ent_idx_wet)),
-                        'conv_arr':list(conv_arr),
-                        'kb_arr':list(kb_arr), 
+                        'conv_arr':memory.conv_arr(),
+                        'kb_arr':memory.kb_arr(), 
                         'id':int(sample_counter),
                         'ID':int(cnt_lin),
                         'domain':task_type}
                     data.append(data_detail)
                     
                     gen_r = generate_memory(r, "$s", str(nid)) 
-                    context_arr += gen_r
-                    conv_arr += gen_r
+                    positions.add_back(gen_r)
+                    memory.add_conv(gen_r)
                     if max_resp_len < len(r.split()):
                         max_resp_len = len(r.split())
                     sample_counter += 1
                 else:
                     r = line
                     kb_info = generate_memory(r, "", str(nid))
-                    context_arr = kb_info + context_arr
-                    kb_arr += kb_info
+                    positions.add_front(kb_info)
+                    memory.add_kb(kb_info)
             else:
                 cnt_lin += 1
-                context_arr, conv_arr, kb_arr = [], [], []
+                memory = DialogueMemory()
+                positions = LastPosition()
                 if(max_line and cnt_lin >= max_line):
                     break
 
@@ -108,17 +111,7 @@ def generate_template(global_entity, sentence, sent_ent, kb_arr, domain):
                             ent_type = kb_item[1]
                             break
                 if ent_type == None:
-                    for key in global_entity.keys():
-                        if key!='poi':
-                            global_entity[key] = [x.lower() for x in global_entity[key]]
-                            if word in global_entity[key] or word.replace('_', ' ') in global_entity[key]:
-                                ent_type = key
-                                break
-                        else:
-                            poi_list = [d['poi'].lower() for d in global_entity['poi']]
-                            if word in poi_list or word.replace('_', ' ') in poi_list:
-                                ent_type = key
-                                break
+                    ent_type = global_entity.get(word)
                 sketch_response.append('@'+ent_type)        
     sketch_response = " ".join(sketch_response)
     return sketch_response
@@ -137,28 +130,36 @@ def generate_memory(sent, speaker, time):
     return sent_new
 
 
-def prepare_data_seq(task, batch_size=100):
+def data_files(task):
+    """The data file of every split, the files read_langs depends on and its extra arguments."""
     # file_train = 'data/KVR/{}train.txt'.format(task)
     # file_dev = 'data/KVR/{}dev.txt'.format(task)
     # file_test = 'data/KVR/{}test.txt'.format(task)
-    file_train = 'data/KVR/{}train_modified.txt'.format(task)
-    file_dev = 'data/KVR/{}dev_modified.txt'.format(task)
-    file_test = 'data/KVR/{}test_modified.txt'.format(task)
-
-    pair_train, train_max_len = read_langs(file_train, max_line=None)
-    pair_dev, dev_max_len = read_langs(file_dev, max_line=None)
-    pair_test, test_max_len = read_langs(file_test, max_line=None)
-    max_resp_len = max(train_max_len, dev_max_len, test_max_len) + 1
+    files = {split: 'data/KVR/{}{}_modified.txt'.format(task, split) for split in ['train', 'dev', 'test']}
+    if args['raw_json']:
+        # only dev and test ship with the repo, kvret_train_public.json comes from the KVRET release
+        files = {split: os.path.join(args['raw_dir'], 'kvret_{}_public.json'.format(split)) for split in ['train', 'dev', 'test']}
+        missing = [f for f in files.values() if not os.path.exists(f)]
+        if missing:
+            raise FileNotFoundError("{} not found: -raw reads the kvret_*_public.json files of the KVRET "
+                                    "dataset release (kvret_dataset_public.zip), put them in -rd".format(', '.join(missing)))
+    return files, ['data/KVR/kvret_entities.json'], ()
+
+
+def prepare_data_seq(task, batch_size=100):
+    files, deps, read_args = data_files(task)
+    split_train, split_dev, split_test = train_splits(read_langs, [files['train'], files['dev'], files['test']], deps, *read_args)
+    # the other splits are only read when a model is evaluated on them
+    max_resp_len = split_train.max_resp_len + 1
     
-    lang = Lang()
+    lang = split_train.vocab if args['shard_dir'] else Lang()
 
-    train = get_seq(pair_train, lang, batch_size, True)
-    dev   = get_seq(pair_dev, lang, batch_size, False)
-    test  = get_seq(pair_test, lang, batch_size, False)
+    train = get_seq(split_train.pairs(), lang, batch_size, True)
+    lang = lang.freeze()
+    dev   = LazyLoader(split_dev, lang, batch_size)
+    test  = LazyLoader(split_test, lang, batch_size)
     
-    print("Read %s sentence pairs train" % len(pair_train))
-    print("Read %s sentence pairs dev" % len(pair_dev))
-    print("Read %s sentence pairs test" % len(pair_test))  
+    print("Read %s sentence pairs train" % split_train.n_samples)
     print("Vocab_size: %s " % lang.n_words)
     print("Max. length of system response: %s " % max_resp_len)
     print("USE_CUDA={}".format(USE_CUDA))
@@ -166,8 +167,20 @@ def prepare_data_seq(task, batch_size=100):
     return train, dev, test, [], lang, max_resp_len
 
 
+def prepare_test_seq(task, lang, max_resp_len, batch_size=100):
+    """Test split only, for a model whose vocabulary comes from load_vocab."""
+    files, deps, read_args = data_files(task)
+    split_test, = lazy_splits(read_langs, [files['test']], deps, *read_args)
+    test = LazyLoader(split_test, lang, batch_size)
+
+    print("Vocab_size: %s " % lang.n_words)
+    print("USE_CUDA={}".format(USE_CUDA))
+
+    return test, []
+
+
 def get_data_seq(file_name, lang, max_len, batch_size=1):
-    pair, _ = read_langs(file_name, max_line=None)
+    pair, _ = read_langs_cached(read_langs, file_name, ['data/KVR/kvret_entities.json'])
     # print(pair)
     d = get_seq(pair, lang, batch_size, False)
     return d
\ No newline at end of file
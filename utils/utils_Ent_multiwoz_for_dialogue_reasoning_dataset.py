@@ -7,6 +7,7 @@ from utils.utils_general import *
 def read_langs(file_name, max_line=None):
     print(("Reading lines from {}".format(file_name)))
     data, context_arr, conv_arr, kb_arr = [], [], [], []
+    positions = LastPosition()
     max_resp_len = 0
 
     # with open('data/KVR/kvret_entities.json') as f:
@@ -37,6 +38,7 @@ def read_langs(file_name, max_line=None):
                         continue
                     r = " ".join(r.split())
                     gen_u = generate_memory(u, "$u", str(nid))
+                    positions.add_back(gen_u)
                     context_arr += gen_u
                     conv_arr += gen_u
 
@@ -54,16 +56,12 @@ def read_langs(file_name, max_line=None):
                     # Get local pointer position for each word in system response
                     ptr_index = []
                     for key in r.split():
-                        index = [loc for loc, val in enumerate(context_arr) if (val[0] == key and key in ent_index)]
-                        if (index):
-                            index = max(index)
-                        else:
-                            index = len(context_arr)
-                        ptr_index.append(index)
+                        index = positions.get(key) if key in ent_index else None
+                        ptr_index.append(len(context_arr) if index is None else index)
 
                     # Get global pointer labels for words in system response, the 1 in the end is for the NULL token
-                    selector_index = [1 if (word_arr[0] in ent_index or word_arr[0] in r.split()) else 0 for word_arr in
-                                      context_arr] + [1]
+                    selected = set(ent_index) | set(r.split())
+                    selector_index = [1 if word_arr[0] in selected else 0 for word_arr in context_arr] + [1]
 
                     sketch_response = generate_template(global_entity, r, gold_ent, kb_arr, task_type)
 
@@ -85,6 +83,7 @@ def read_langs(file_name, max_line=None):
                     data.append(data_detail)
 
                     gen_r = generate_memory(r, "$s", str(nid))
+                    positions.add_back(gen_r)
                     context_arr += gen_r
                     conv_arr += gen_r
                     if max_resp_len < len(r.split()):
@@ -98,6 +97,7 @@ def read_langs(file_name, max_line=None):
                             print(kb_info)
                             print(r)
                         context_arr = kb_info + context_arr
+                        positions.add_front(kb_info)
                         # temp = []
                         # for triple in kb_info:
                         #     t = []
@@ -111,6 +111,7 @@ def read_langs(file_name, max_line=None):
             else:
                 cnt_lin += 1
                 context_arr, conv_arr, kb_arr = [], [], []
+                positions = LastPosition()
                 if (max_line and cnt_lin >= max_line):
                     break
 
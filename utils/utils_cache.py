@@ -0,0 +1,259 @@
+import os
+import shutil
+import pickle
+import hashlib
+import numpy as np
+from utils.config import *
+from utils.utils_dialogue import read_langs_parallel, read_langs_sample, DialogueMemory, MemoryView
+
+'''
+On-disk cache of the samples produced by read_langs.
+
+Each cached file is a directory holding .npy arrays and a meta.pkl with the
+symbol table and the small per-sample fields, plus an info.pkl with
+max_resp_len and the number of samples, read by LazySplit without loading the
+samples. Words are stored as ids into the symbol table of the file, not into a
+vocabulary, which is built after loading: load_pairs decodes them back to the
+strings read_langs returns, one whole column at a time. The KB and dialogue
+history rows are stored once per dialogue, and the memory fields of a sample
+as the (dialogue, n_kb, n_conv) of its MemoryView. A file that is not cached
+is parsed, and cached, the first time its samples are needed.
+
+The directory name carries a hash of the source file, its dependencies
+(entity tables, KB files), the reader module, dataset, task, MEM_TOKEN_SIZE
+and CACHE_VERSION, so any change to the inputs selects a new cache entry and
+the stale one is removed.
+'''
+
+CACHE_VERSION = 2
+TRIPLE_FIELDS = ['context_arr', 'conv_arr', 'kb_arr']
+TOKEN_FIELDS = ['response', 'sketch_response']
+INDEX_FIELDS = ['ptr_index', 'selector_index']
+
+
+def file_hash(file_name):
+    h = hashlib.sha1()
+    with open(file_name, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def cache_key(file_name, deps, reader):
+    h = hashlib.sha1()
+    h.update(str([CACHE_VERSION, reader, args['dataset'], args['task'], MEM_TOKEN_SIZE]).encode('utf-8'))
+    for f in [file_name] + list(deps):
+        h.update(file_hash(f).encode('utf-8'))
+    return h.hexdigest()
+
+
+def cache_path(file_name, reader, key):
+    name = os.path.splitext(os.path.basename(file_name))[0]
+    return os.path.join(CACHE_DIR, '{}.{}.{}'.format(reader.split('.')[-1], name, key[:16]))
+
+
+def remove_stale(path):
+    """Remove cache entries of the same reader and file built from other inputs."""
+    prefix = os.path.basename(path).rsplit('.', 1)[0] + '.'
+    for entry in os.listdir(os.path.dirname(path)):
+        if entry.startswith(prefix) and entry != os.path.basename(path):
+            entry = os.path.join(os.path.dirname(path), entry)
+            if os.path.isdir(entry):
+                shutil.rmtree(entry, ignore_errors=True)
+            else:
+                os.remove(entry)
+
+
+def save_pairs(path, pairs, max_resp_len, key):
+    symbols, symbol2id = [], {}
+
+    def encode(word):
+        if word not in symbol2id:
+            symbol2id[word] = len(symbols)
+            symbols.append(word)
+        return symbol2id[word]
+
+    def encode_rows(rows):
+        if any(len(row) != MEM_TOKEN_SIZE for row in rows):
+            raise ValueError("memory rows are not {} tokens wide".format(MEM_TOKEN_SIZE))
+        return [[encode(w) for w in row] for row in rows]
+
+    fields = list(pairs[0].keys()) if pairs else []
+    arrays, extra = {}, [{} for _ in pairs]
+
+    # the rows of every dialogue memory are stored once, the samples keep views into them
+    memories, memory_ids = [], {}
+    for k in fields:
+        if k in TRIPLE_FIELDS:
+            views = []
+            for pair in pairs:
+                view = pair[k]
+                if not isinstance(view, MemoryView):
+                    raise ValueError("{} is not a dialogue memory view".format(k))
+                if id(view.memory) not in memory_ids:
+                    memory_ids[id(view.memory)] = len(memories)
+                    memories.append(view.memory)
+                views.append([memory_ids[id(view.memory)], view.n_kb, view.n_conv, view.reverse_kb, view.null])
+            arrays[k+'_views'] = np.array(views, dtype=np.int64).reshape(-1, 5)
+        elif k in TOKEN_FIELDS:
+            arrays[k] = np.array([encode(w) for pair in pairs for w in pair[k].split(' ')], dtype=np.int32)
+            lengths = [len(pair[k].split(' ')) for pair in pairs]
+            arrays[k+'_offsets'] = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        elif k in INDEX_FIELDS:
+            arrays[k] = np.array([i for pair in pairs for i in pair[k]], dtype=np.int32)
+            lengths = [len(pair[k]) for pair in pairs]
+            arrays[k+'_offsets'] = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        else:
+            for i, pair in enumerate(pairs):
+                extra[i][k] = pair[k]
+    for part in ['kb', 'conv']:
+        rows = [row for memory in memories for row in encode_rows(getattr(memory, part))]
+        arrays[part] = np.array(rows, dtype=np.int32).reshape(-1, MEM_TOKEN_SIZE)
+        lengths = [len(getattr(memory, part)) for memory in memories]
+        arrays[part+'_offsets'] = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+
+    meta = {'version':CACHE_VERSION, 'key':key, 'max_resp_len':max_resp_len,
+            'fields':fields, 'symbols':symbols, 'extra':extra}
+
+    # write into a temporary directory first so readers never see a partial entry
+    tmp_path = '{}.tmp{}'.format(path, os.getpid())
+    os.makedirs(tmp_path)
+    for k, arr in arrays.items():
+        np.save(os.path.join(tmp_path, k+'.npy'), arr)
+    with open(os.path.join(tmp_path, 'meta.pkl'), 'wb') as f:
+        pickle.dump(meta, f, protocol=pickle.HIGHEST_PROTOCOL)
+    with open(os.path.join(tmp_path, 'info.pkl'), 'wb') as f:
+        pickle.dump({'max_resp_len':max_resp_len, 'n_samples':len(pairs)}, f, protocol=pickle.HIGHEST_PROTOCOL)
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def load_pairs(path):
+    with open(os.path.join(path, 'meta.pkl'), 'rb') as f:
+        meta = pickle.load(f)
+    symbols = np.array(meta['symbols'], dtype=object)
+
+    def load_column(k):
+        arr = np.load(os.path.join(path, k+'.npy'))
+        offsets = np.load(os.path.join(path, k+'_offsets.npy')).tolist()
+        # decode the whole column at once, then cut it into samples
+        column = arr.tolist() if k in INDEX_FIELDS else symbols[arr].tolist()
+        return [column[offsets[i]:offsets[i+1]] for i in range(len(offsets)-1)]
+
+    memories = []
+    if any(k in TRIPLE_FIELDS for k in meta['fields']):
+        memories = [DialogueMemory(kb, conv) for kb, conv in zip(load_column('kb'), load_column('conv'))]
+
+    pairs = [dict(e) for e in meta['extra']]
+    for k in meta['fields']:
+        if k in TRIPLE_FIELDS:
+            views = np.load(os.path.join(path, k+'_views.npy')).tolist()
+            for pair, (m, n_kb, n_conv, reverse_kb, null) in zip(pairs, views):
+                pair[k] = MemoryView(memories[m], n_kb, n_conv, reverse_kb=bool(reverse_kb), null=bool(null))
+        elif k in TOKEN_FIELDS + INDEX_FIELDS:
+            for pair, seq in zip(pairs, load_column(k)):
+                pair[k] = ' '.join(seq) if k in TOKEN_FIELDS else seq
+    # restore the original key order of the sample dicts
+    pairs = [dict((k, pair[k]) for k in meta['fields']) for pair in pairs]
+    return pairs, meta['max_resp_len']
+
+
+def load_info(path):
+    """max_resp_len and n_samples of a cache entry (from meta.pkl for entries without info.pkl)."""
+    if os.path.exists(os.path.join(path, 'info.pkl')):
+        with open(os.path.join(path, 'info.pkl'), 'rb') as f:
+            return pickle.load(f)
+    with open(os.path.join(path, 'meta.pkl'), 'rb') as f:
+        meta = pickle.load(f)
+    return {'max_resp_len':meta['max_resp_len'], 'n_samples':len(meta['extra'])}
+
+
+class LazySplit:
+    """
+    The samples of one data file, loaded by pairs() from the cache entry at path, or, for a
+    file that is not cached, parsed by parse() the first time pairs(), max_resp_len or
+    n_samples is needed. Those of a cached file are known without loading the samples.
+    """
+    def __init__(self, file_name, path=None, parse=None):
+        self.file_name = file_name
+        self.path = path
+        self.parse = parse
+        self.parsed = None
+        self.info = load_info(path) if parse is None else None
+
+    def load(self):
+        """(pairs, max_resp_len) of the file, parsed on the first call."""
+        if self.parsed is None:
+            self.parsed = self.parse()
+            print("Read {} sentence pairs of {}".format(len(self.parsed[0]), self.file_name))
+        return self.parsed
+
+    @property
+    def max_resp_len(self):
+        return self.info['max_resp_len'] if self.parse is None else self.load()[1]
+
+    @property
+    def n_samples(self):
+        return self.info['n_samples'] if self.parse is None else len(self.load()[0])
+
+    def pairs(self):
+        if self.parse is None:
+            print("Loading cached samples of {}".format(self.file_name))
+            return load_pairs(self.path)[0]
+        return self.load()[0]
+
+
+def read_langs_cached(read_langs, file_name, deps, *read_args):
+    """
+    Same as read_langs(file_name, *read_args), but served from the on-disk cache when
+    neither file_name nor any of deps has changed since the last parse.
+    """
+    return read_splits(read_langs, [file_name], deps, *read_args)[0]
+
+
+def read_splits(read_langs, file_names, deps, *read_args):
+    """read_langs_cached over several files (the train/dev/test splits of a dataset)."""
+    return [(split.pairs(), split.max_resp_len) for split in lazy_splits(read_langs, file_names, deps, *read_args)]
+
+
+def parse_and_cache(read_langs, file_name, deps, read_args):
+    """
+    read_langs(file_name, *read_args), split in args['parse_proc'] processes, saved to the
+    cache with -cache.
+    """
+    (pairs, max_resp_len), = read_langs_parallel(read_langs, [file_name], read_args, args['parse_proc'])
+    if args['cache']:
+        key = cache_key(file_name, deps, read_langs.__module__)
+        path = cache_path(file_name, read_langs.__module__, key)
+        try:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            save_pairs(path, pairs, max_resp_len, key)
+            remove_stale(path)
+        except (OSError, ValueError) as e:
+            print("[WARNING] Cannot cache {}: {}".format(file_name, e))
+    return pairs, max_resp_len
+
+
+def lazy_splits(read_langs, file_names, deps, *read_args):
+    """
+    A LazySplit for each of file_names. Nothing is read up front: cached files are loaded
+    when their pairs() are needed, the others are parsed and cached then. With -sample, only
+    the drawn dialogues of every file are parsed, bypassing the cache.
+    """
+    splits = []
+    for file_name in file_names:
+        if args['sample']:
+            parse = lambda file_name=file_name: read_langs_sample(read_langs, file_name, read_args, args['sample'], args['sample_seed'])
+            splits.append(LazySplit(file_name, parse=parse))
+            continue
+        if args['cache']:
+            key = cache_key(file_name, deps, read_langs.__module__)
+            path = cache_path(file_name, read_langs.__module__, key)
+            if os.path.exists(os.path.join(path, 'meta.pkl')):
+                splits.append(LazySplit(file_name, path=path))
+                continue
+        parse = lambda file_name=file_name: parse_and_cache(read_langs, file_name, deps, read_args)
+        splits.append(LazySplit(file_name, parse=parse))
+    return splits
@@ -0,0 +1,114 @@
+import sys
+sys.argv = sys.argv[:1] + ['-ds=kvr']  # utils.config parses the command line on import
+
+import os
+import shutil
+import tempfile
+from utils.config import *
+import utils.utils_cache as cache
+import utils.utils_Ent_kvr as kvr
+from utils.utils_dialogue import MemoryView
+from utils.utils_general import LazyLoader, get_seq
+from utils.utils_testing import build_lang, assert_same_batch
+
+'''
+A cache hit returns the pairs read_langs parses, field by field, without
+parsing the file again, a file missing from the cache is parsed and cached
+only when its samples are needed, and changing the source file or a
+dependency selects a new cache entry and removes the stale one. A LazySplit
+of a cached file knows its size without loading it, and its LazyLoader,
+built on first use, yields the batches of the eagerly parsed split.
+
+Command:
+
+python -m pytest utils/utils_cache_test.py
+
+'''
+
+FILE = 'data/KVR/dev_modified.txt'
+DEPS = ['data/KVR/kvret_entities.json']
+
+
+def plain(pair):
+    return dict((k, [list(row) for row in v] if isinstance(v, MemoryView) else v) for k, v in pair.items())
+
+
+def first_dialogues(file_name, out, n):
+    with open(file_name) as fin, open(out, 'w') as fout:
+        for line in fin:
+            fout.write(line)
+            if not line.strip():
+                n -= 1
+                if n == 0:
+                    break
+
+
+def split(file_name, dep):
+    return cache.lazy_splits(kvr.read_langs, [file_name], [dep])[0]
+
+
+def test_cache():
+    cache_dir = cache.CACHE_DIR
+    with tempfile.TemporaryDirectory() as directory:
+        cache.CACHE_DIR = os.path.join(directory, 'cache')
+        try:
+            file_name, dep = os.path.join(directory, 'dev.txt'), os.path.join(directory, 'entities.json')
+            first_dialogues(FILE, file_name, 20)
+            shutil.copy(DEPS[0], dep)
+
+            # a file missing from the cache is only parsed, and cached, when its samples are needed
+            parsed = split(file_name, dep)
+            assert parsed.parsed is None and not os.path.exists(cache.CACHE_DIR)
+            parsed.pairs()
+            assert parsed.parsed is not None and len(os.listdir(cache.CACHE_DIR)) == 1
+            hit = split(file_name, dep)
+            assert hit.parse is None and hit.max_resp_len == parsed.max_resp_len
+            pairs, _ = kvr.read_langs(file_name)
+            assert [plain(p) for p in hit.pairs()] == [plain(p) for p in pairs]
+
+            # a changed dependency and a changed source each select a new entry
+            entry = os.listdir(cache.CACHE_DIR)
+            with open(dep, 'a') as f:
+                f.write('\n')
+            assert split(file_name, dep).parse is not None
+            split(file_name, dep).pairs()
+            assert split(file_name, dep).parse is None
+            assert len(os.listdir(cache.CACHE_DIR)) == 1 and os.listdir(cache.CACHE_DIR) != entry
+
+            entry = os.listdir(cache.CACHE_DIR)
+            first_dialogues(FILE, file_name, 10)
+            changed = split(file_name, dep)
+            assert changed.parse is not None and changed.n_samples < parsed.n_samples
+            assert len(os.listdir(cache.CACHE_DIR)) == 1 and os.listdir(cache.CACHE_DIR) != entry
+        finally:
+            cache.CACHE_DIR = cache_dir
+
+
+def test_lazy_split():
+    cache_dir = cache.CACHE_DIR
+    with tempfile.TemporaryDirectory() as directory:
+        cache.CACHE_DIR = os.path.join(directory, 'cache')
+        try:
+            file_name = os.path.join(directory, 'dev.txt')
+            first_dialogues(FILE, file_name, 30)
+            pairs, max_resp_len = kvr.read_langs(file_name)
+            split(file_name, DEPS[0]).pairs()
+            lazy = split(file_name, DEPS[0])
+            assert lazy.parse is None
+            assert (lazy.n_samples, lazy.max_resp_len) == (len(pairs), max_resp_len)
+
+            vocab = build_lang(pairs).freeze()
+            loader = LazyLoader(lazy, vocab, 8)
+            assert loader.loader is None
+            eager = get_seq(pairs, vocab, 8, False)
+            assert len(loader) == len(eager) and loader.loader is not None
+            for a, b in zip(eager, loader):
+                assert_same_batch(a, b)
+            assert [plain(p) for p in lazy.pairs()] == [plain(p) for p in pairs]
+        finally:
+            cache.CACHE_DIR = cache_dir
+
+
+if __name__=="__main__":
+    test_cache()
+    test_lazy_split()
@@ -0,0 +1,330 @@
+import io
+import os
+import mmap
+import random
+import hashlib
+import multiprocessing
+import numpy as np
+from itertools import islice
+from collections.abc import Sequence
+from utils.config import *
+
+'''
+Dialogue-level access to the raw data files and to the parsed memories.
+
+Dialogues are separated by blank lines and parse independently, so a file can
+be cut at dialogue boundaries into FileChunks that read_langs parses on its
+own (read_langs opens its input through open_dialogues). Raw .json files are
+converted on the fly by utils_json and parsed in one piece.
+
+The dialogue boundaries of a text file come from its dialogue_index, built on
+the first read and saved under CACHE_DIR. split_dialogues uses it to cut files
+for parallel parsing, and a DialogueFile to read single dialogues from an mmap
+of the file for -sample.
+
+Every turn of a dialogue sees a prefix of the same KB rows and dialogue
+history, so the rows are stored once per dialogue in a DialogueMemory and the
+context_arr/conv_arr/kb_arr of a sample are MemoryViews over it.
+'''
+
+
+class DialogueMemory:
+    """KB rows (in file order) and dialogue history rows of one dialogue."""
+    def __init__(self, kb=None, conv=None):
+        self.kb = [] if kb is None else kb
+        self.conv = [] if conv is None else conv
+        self.null_row = ['$$$$']*MEM_TOKEN_SIZE # $$$$ is NULL token
+
+    def add_kb(self, rows):
+        self.kb += rows
+
+    def add_conv(self, rows):
+        self.conv += rows
+
+    def context_arr(self, null=True):
+        """KB rows, last one first as they are prepended to the memory, then the dialogue history."""
+        return MemoryView(self, len(self.kb), len(self.conv), reverse_kb=True, null=null)
+
+    def conv_arr(self):
+        return MemoryView(self, 0, len(self.conv))
+
+    def kb_arr(self, null=False):
+        return MemoryView(self, len(self.kb), 0, null=null)
+
+
+class MemoryView(Sequence):
+    """
+    Read-only sequence over the first n_kb KB rows and the first n_conv history rows of a
+    DialogueMemory, optionally followed by the NULL row. Later turns only append rows to the
+    memory, so a view keeps showing the memory as it was when the view was taken.
+    """
+    __slots__ = ('memory', 'n_kb', 'n_conv', 'reverse_kb', 'null')
+
+    def __init__(self, memory, n_kb, n_conv, reverse_kb=False, null=False):
+        self.memory = memory
+        self.n_kb = n_kb
+        self.n_conv = n_conv
+        self.reverse_kb = reverse_kb
+        self.null = null
+
+    def __len__(self):
+        return self.n_kb + self.n_conv + int(self.null)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if 0 <= i < self.n_kb:
+            return self.memory.kb[self.n_kb-1-i if self.reverse_kb else i]
+        if self.n_kb <= i < self.n_kb + self.n_conv:
+            return self.memory.conv[i-self.n_kb]
+        if self.null and i == self.n_kb + self.n_conv:
+            return self.memory.null_row
+        raise IndexError('memory view index out of range')
+
+    def __iter__(self):
+        kb = self.memory.kb
+        if self.reverse_kb:
+            for i in range(self.n_kb-1, -1, -1):
+                yield kb[i]
+        else:
+            yield from islice(kb, self.n_kb)
+        yield from islice(self.memory.conv, self.n_conv)
+        if self.null:
+            yield self.memory.null_row
+
+    def __eq__(self, other):
+        if isinstance(other, (MemoryView, list, tuple)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+class FileChunk:
+    """
+    Byte range [start, end) of a data file that starts at a dialogue boundary.
+    blank_lines is the number of blank lines before start, used to renumber the
+    dialogue ID the way a parse of the whole file would.
+    """
+    def __init__(self, file_name, start, end, blank_lines=0):
+        self.file_name = file_name
+        self.start = start
+        self.end = end
+        self.blank_lines = blank_lines
+
+    def __str__(self):
+        return '{}[{}:{}]'.format(self.file_name, self.start, self.end)
+
+    def read(self):
+        with open(self.file_name, 'rb') as f:
+            f.seek(self.start)
+            return f.read(self.end - self.start).decode('utf-8')
+
+
+class DialogueSample:
+    """
+    The dialogues indices of a DialogueFile, read on their own and joined by single blank
+    lines. ids are their dialogue IDs in the whole file.
+    """
+    def __init__(self, dialogues, indices):
+        self.dialogues = dialogues
+        self.file_name = dialogues.file_name
+        self.indices = list(indices)
+        self.ids = dialogues.index[self.indices, ID].tolist()
+
+    def __str__(self):
+        return '{}[{} dialogues]'.format(self.file_name, len(self.indices))
+
+    def read(self):
+        return ''.join(self.dialogues.text(k) for k in self.indices)
+
+
+def open_dialogues(source):
+    """Opens a file name, a FileChunk or a DialogueSample for line iteration."""
+    file_name = source if isinstance(source, str) else source.file_name
+    if file_name.endswith('.json'):
+        from utils.utils_json import JsonDialogues
+        return JsonDialogues(file_name)
+    if isinstance(source, (FileChunk, DialogueSample)):
+        return io.StringIO(source.read())
+    return open(source)
+
+
+START, END, ID, N_TURNS, N_KB = range(5) # columns of a dialogue index
+_indexes = {}
+
+
+def build_dialogue_index(file_name):
+    """
+    [n_dialogues, 5] int64 array of the byte range [START, END) of every dialogue of file_name
+    (trailing blank lines excluded), its ID (one more than the blank lines before it) and its
+    numbers of turns (N_TURNS) and KB rows (N_KB).
+    """
+    rows, offset, blank_lines, current = [], 0, 0, None
+    with open(file_name, 'rb') as f:
+        for line in f:
+            stripped = line.strip()
+            if stripped:
+                if current is None:
+                    current = [offset, offset, blank_lines + 1, 0, 0]
+                    rows.append(current)
+                if b'\t' in stripped:
+                    current[N_TURNS] += 1
+                elif not stripped.startswith(b'#'):
+                    current[N_KB] += 1
+                current[END] = offset + len(line)
+            else:
+                blank_lines += 1
+                current = None
+            offset += len(line)
+    return np.array(rows, dtype=np.int64).reshape(-1, 5)
+
+
+def dialogue_index(file_name):
+    """
+    The build_dialogue_index of file_name, saved under CACHE_DIR on the first read and
+    rebuilt when the size or modification time of the file changes.
+    """
+    stat = os.stat(file_name)
+    stamp = [stat.st_size, stat.st_mtime_ns]
+    if file_name in _indexes and _indexes[file_name][0] == stamp:
+        return _indexes[file_name][1]
+    name = os.path.splitext(os.path.basename(file_name))[0]
+    path_hash = hashlib.sha1(os.path.abspath(file_name).encode('utf-8')).hexdigest()[:16]
+    path = os.path.join(CACHE_DIR, 'index.{}.{}.npz'.format(name, path_hash))
+    index = None
+    if args['cache'] and os.path.exists(path):
+        with np.load(path) as saved:
+            if saved['stamp'].tolist() == stamp:
+                index = saved['index']
+    if index is None:
+        index = build_dialogue_index(file_name)
+        if args['cache']:
+            try:
+                os.makedirs(CACHE_DIR, exist_ok=True)
+                tmp_path = '{}.tmp{}'.format(path, os.getpid())
+                with open(tmp_path, 'wb') as f:
+                    np.savez(f, index=index, stamp=np.array(stamp, dtype=np.int64))
+                os.replace(tmp_path, path)
+            except OSError as e:
+                print("[WARNING] Cannot save the dialogue index of {}: {}".format(file_name, e))
+    _indexes[file_name] = (stamp, index)
+    return index
+
+
+class DialogueFile:
+    """
+    Random access to the dialogues of a text data file through its dialogue_index. Dialogues
+    are read from a read-only mmap of the file, opened on first use (and in every process).
+    """
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.index = dialogue_index(file_name)
+        self.mm = None
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['mm'] = None
+        return state
+
+    def text(self, k):
+        """Lines of dialogue k followed by a blank line."""
+        if self.mm is None:
+            with open(self.file_name, 'rb') as f:
+                self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.mm[self.index[k, START]:self.index[k, END]].decode('utf-8').rstrip('\n') + '\n\n'
+
+    def parse(self, read_langs, indices, read_args=()):
+        """
+        read_langs(..., *read_args) over the dialogues indices only. The samples keep the ID
+        of their dialogue in the file.
+        """
+        sample = DialogueSample(self, indices)
+        pairs, max_resp_len = read_langs(sample, *read_args)
+        for pair in pairs:
+            pair['ID'] = sample.ids[pair['ID'] - 1]
+        return pairs, max_resp_len
+
+
+def split_dialogues(file_name, n_chunks):
+    """Cuts file_name into at most n_chunks FileChunks of similar byte size at dialogue boundaries."""
+    if file_name.endswith('.json'):
+        return [FileChunk(file_name, 0, os.path.getsize(file_name))]
+    index, size = dialogue_index(file_name), os.path.getsize(file_name)
+    chunks, target = [], size / float(max(n_chunks, 1))
+    chunk_start, chunk_blank = 0, 0
+    for offset, dialogue_id in index[1:, [START, ID]].tolist():
+        if offset - chunk_start >= target:
+            chunks.append(FileChunk(file_name, chunk_start, offset, chunk_blank))
+            chunk_start, chunk_blank = offset, dialogue_id - 1
+    chunks.append(FileChunk(file_name, chunk_start, size, chunk_blank))
+    return chunks
+
+
+def draw_dialogues(n_dialogues, n_samples, seed):
+    """Sorted indices of n_samples of n_dialogues dialogues, the same for the same seed."""
+    return sorted(random.Random(seed).sample(range(n_dialogues), min(n_samples, n_dialogues)))
+
+
+def read_langs_sample(read_langs, file_name, read_args, n_samples, seed):
+    """
+    read_langs(file_name, *read_args) over n_samples dialogues of file_name drawn with seed,
+    reading and parsing only those. The samples keep the ID of their dialogue in the file.
+    """
+    if file_name.endswith('.json'):
+        # raw json has no dialogue offsets: parse it all and keep the drawn dialogues
+        pairs, _ = read_langs(file_name, *read_args)
+        n_dialogues = max([pair['ID'] for pair in pairs] + [0])
+        ids = set(i + 1 for i in draw_dialogues(n_dialogues, n_samples, seed))
+        pairs = [pair for pair in pairs if pair['ID'] in ids]
+        return pairs, max([len(pair['response'].split()) for pair in pairs] + [0])
+    dialogues = DialogueFile(file_name)
+    chosen = draw_dialogues(len(dialogues), n_samples, seed)
+    print("Sampled {} dialogues of {}".format(len(chosen), file_name))
+    return dialogues.parse(read_langs, chosen, read_args)
+
+
+def parse_chunk(read_langs, chunk, read_args):
+    return read_langs(chunk, *read_args)
+
+
+def merge_chunks(chunks, results):
+    """Concatenates the samples of consecutive chunks of one file, renumbering ID and id."""
+    data, max_resp_len = [], 0
+    for chunk, (pairs, chunk_max_resp_len) in zip(chunks, results):
+        n_samples = len(data)
+        for pair in pairs:
+            pair['ID'] += chunk.blank_lines
+            pair['id'] += n_samples
+        data += pairs
+        max_resp_len = max(max_resp_len, chunk_max_resp_len)
+    return data, max_resp_len
+
+
+def read_langs_parallel(read_langs, file_names, read_args, processes):
+    """
+    Parses all file_names with read_langs(file_name, *read_args) in a pool of processes,
+    splitting every file at dialogue boundaries. Returns [(data, max_resp_len)] in file order,
+    identical to parsing each file serially.
+    """
+    if processes <= 1:
+        return [read_langs(file_name, *read_args) for file_name in file_names]
+
+    chunks = [split_dialogues(file_name, 4*processes) for file_name in file_names]
+    tasks = [(read_langs, chunk, read_args) for file_chunks in chunks for chunk in file_chunks]
+    with multiprocessing.Pool(processes) as pool:
+        results = pool.starmap(parse_chunk, tasks)
+
+    outputs, i = [], 0
+    for file_chunks in chunks:
+        outputs.append(merge_chunks(file_chunks, results[i:i+len(file_chunks)]))
+        i += len(file_chunks)
+    return outputs
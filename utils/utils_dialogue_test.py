@@ -0,0 +1,91 @@
+import sys
+sys.argv = sys.argv[:1] + ['-ds=kvr']  # utils.config parses the command line on import
+
+from utils.config import *
+import utils.utils_Ent_kvr as kvr
+from utils.utils_dialogue import split_dialogues, read_langs_parallel, read_langs_sample, DialogueMemory, DialogueFile, build_dialogue_index, ID, N_TURNS
+
+'''
+Memory views over a DialogueMemory match the per-turn lists they replace, and
+parsing files cut at dialogue boundaries in a process pool gives the samples,
+ID/id numbering and max_resp_len of a serial parse. A seeded -sample draw
+parses to the samples of the drawn dialogues in the whole file, and so does
+a single dialogue read through the dialogue index.
+
+Command:
+
+python -m pytest utils/utils_dialogue_test.py
+
+'''
+
+FILES = ['data/KVR/dev_modified.txt', 'data/KVR/test_modified.txt']
+
+
+def test_memory_views():
+    memory, context_arr, conv_arr, kb_arr = DialogueMemory(), [], [], []
+    for kind, rows in [('kb', [['k1']]), ('kb', [['k2']]), ('conv', [['u1'], ['u2']]), ('kb', [['k3']]), ('conv', [['s1']])]:
+        if kind == 'kb':
+            memory.add_kb(rows)
+            context_arr = rows + context_arr
+            kb_arr += rows
+        else:
+            memory.add_conv(rows)
+            context_arr += rows
+            conv_arr += rows
+        assert list(memory.context_arr()) == context_arr + [memory.null_row]
+        assert list(memory.context_arr(null=False)) == context_arr
+        assert memory.conv_arr() == conv_arr
+        assert memory.kb_arr(null=True)[:-1] == kb_arr
+        assert [memory.context_arr()[i] for i in range(-len(context_arr)-1, 0)] == context_arr + [memory.null_row]
+
+
+def test_split_dialogues():
+    chunks = split_dialogues(FILES[0], 8)
+    assert len(chunks) > 1
+    assert ''.join(chunk.read() for chunk in chunks) == open(FILES[0]).read()
+
+
+def test_read_langs_parallel():
+    serial = read_langs_parallel(kvr.read_langs, FILES, (), 1)
+    parallel = read_langs_parallel(kvr.read_langs, FILES, (), 3)
+    for (pairs, max_resp_len), (ref_pairs, ref_max_resp_len) in zip(parallel, serial):
+        assert max_resp_len == ref_max_resp_len
+        assert len(pairs) == len(ref_pairs)
+        for pair, ref_pair in zip(pairs, ref_pairs):
+            for k in ref_pair:
+                if k.startswith('ent_'):
+                    assert set(pair[k]) == set(ref_pair[k]), (k, ref_pair['ID'])
+                else:
+                    assert pair[k] == ref_pair[k], (k, ref_pair['ID'])
+
+
+def test_read_langs_sample():
+    pairs, _ = read_langs_sample(kvr.read_langs, FILES[0], (), 20, 1)
+    ids = sorted(set(pair['ID'] for pair in pairs))
+    assert len(ids) == 20 and [pair['ID'] for pair in read_langs_sample(kvr.read_langs, FILES[0], (), 20, 1)[0]] == [pair['ID'] for pair in pairs]
+    ref_pairs = [pair for pair in kvr.read_langs(FILES[0])[0] if pair['ID'] in ids]
+    assert len(pairs) == len(ref_pairs)
+    for pair, ref_pair in zip(pairs, ref_pairs):
+        for k in ['ID', 'context_arr', 'response', 'sketch_response', 'ptr_index', 'selector_index']:
+            assert pair[k] == ref_pair[k], (k, ref_pair['ID'])
+
+
+def test_dialogue_file():
+    dialogues = DialogueFile(FILES[1])
+    assert (dialogues.index == build_dialogue_index(FILES[1])).all()
+    assert ''.join(dialogues.text(k) for k in range(len(dialogues))).split() == open(FILES[1]).read().split()
+    pairs, _ = kvr.read_langs(FILES[1])
+    assert int(dialogues.index[:, N_TURNS].sum()) == len(pairs)
+    k = len(dialogues) // 2
+    single, _ = dialogues.parse(kvr.read_langs, [k])
+    ref_pairs = [pair for pair in pairs if pair['ID'] == dialogues.index[k, ID]]
+    assert [pair['response'] for pair in single] == [pair['response'] for pair in ref_pairs]
+    assert [pair['context_arr'] for pair in single] == [pair['context_arr'] for pair in ref_pairs]
+
+
+if __name__=="__main__":
+    test_memory_views()
+    test_split_dialogues()
+    test_read_langs_parallel()
+    test_read_langs_sample()
+    test_dialogue_file()
@@ -0,0 +1,129 @@
+import os
+import json
+import pickle
+from utils.config import *
+from utils.utils_cache import file_hash, remove_stale
+
+'''
+Entity surface form -> slot type index shared by the generate_template functions
+and, for bAbI, by read_langs and candid2DL as the set of KB entities.
+
+Built once per process from the entity table of a dataset and pickled under
+CACHE_DIR next to the dataset cache, keyed on the hash of the table.
+'''
+
+ENTITY_FILES = {
+    'kvr': 'data/KVR/kvret_entities.json',
+    'multiwoz': 'data/multiwoz/multiwoz_entities.json',
+    'babi': 'data/dialog-bAbI-tasks/dialog-babi-kb-all.txt',
+    'dstc2': 'data/dialog-bAbI-tasks/dialog-babi-task6-dstc2-kb.txt'}
+
+ENTITY_INDEX_VERSION = 2 # bump when EntityIndex changes to invalidate the pickles
+
+_entity_indexes = {}
+
+
+class EntityIndex:
+    """
+    Maps every surface form of an entity value to the first slot type that lists it.
+    A value 'a b' is also reachable as 'a_b', matching the underscore-joined tokens of the data files.
+    types() returns all the slot types of a value, in table order.
+    """
+    def __init__(self):
+        self.type_of = {}
+        self.types_of = {}
+
+    def add(self, value, slot_type, underscore=True):
+        forms = [value]
+        if underscore and '_' not in value:
+            forms.append(value.replace(' ', '_'))
+        for form in forms:
+            self.type_of.setdefault(form, slot_type)
+            types = self.types_of.setdefault(form, [])
+            if slot_type not in types:
+                types.append(slot_type)
+
+    def get(self, word, default=None):
+        return self.type_of.get(word, default)
+
+    def types(self, word):
+        return self.types_of.get(word, [])
+
+    def __contains__(self, word):
+        return word in self.type_of
+
+    def __len__(self):
+        return len(self.type_of)
+
+
+def build_kvr_index(file_name):
+    with open(file_name) as f:
+        global_entity = json.load(f)
+    index = EntityIndex()
+    for key in global_entity.keys():
+        if key != 'poi':
+            for value in global_entity[key]:
+                index.add(value.lower(), key)
+        else:
+            for d in global_entity['poi']:
+                index.add(d['poi'].lower(), key)
+    return index
+
+
+def build_multiwoz_index(file_name):
+    with open(file_name) as f:
+        global_entity = json.load(f)
+    index = EntityIndex()
+    for key in global_entity.keys():
+        for value in global_entity[key]:
+            index.add(value.lower(), key)
+    return index
+
+
+def build_babi_index(file_name, dstc2=False):
+    from utils.utils_temp import get_type_dict
+    type_dict = get_type_dict(file_name, dstc2=dstc2)
+    index = EntityIndex()
+    for key in type_dict.keys():
+        for value in type_dict[key]:
+            index.add(value, key, underscore=False)
+    return index
+
+
+def build_dstc2_index(file_name):
+    return build_babi_index(file_name, dstc2=True)
+
+
+def get_entity_index(dataset):
+    """Returns the entity index of dataset, building or unpickling it on first use."""
+    if dataset in _entity_indexes:
+        return _entity_indexes[dataset]
+    file_name = ENTITY_FILES[dataset]
+    path = os.path.join(CACHE_DIR, 'entities.{}.{}v{}'.format(dataset, file_hash(file_name)[:16], ENTITY_INDEX_VERSION))
+    if args['cache'] and os.path.exists(path):
+        with open(path, 'rb') as f:
+            index = pickle.load(f)
+    else:
+        index = globals()['build_{}_index'.format(dataset)](file_name)
+        if args['cache']:
+            try:
+                os.makedirs(CACHE_DIR, exist_ok=True)
+                tmp_path = '{}.tmp{}'.format(path, os.getpid())
+                with open(tmp_path, 'wb') as f:
+                    pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp_path, path)
+                remove_stale(path)
+            except OSError as e:
+                print("[WARNING] Cannot cache the {} entity index: {}".format(dataset, e))
+    _entity_indexes[dataset] = index
+    return index
+
+
+def babi_kb(task):
+    """The entity table of the KB of bAbI task: dstc2 for task 6, babi otherwise."""
+    return 'dstc2' if int(task) == 6 else 'babi'
+
+
+def get_babi_index(task):
+    """Entity index of the KB of bAbI task (the DSTC2 KB for task 6)."""
+    return get_entity_index(babi_kb(task))
@@ -0,0 +1,87 @@
+import sys
+sys.argv = sys.argv[:1] + ['-ds=kvr']  # utils.config parses the command line on import
+
+import json
+from utils.config import *
+from utils.utils_entity import get_entity_index, ENTITY_FILES
+from utils.utils_temp import get_type_dict, load_candidates, candid2DL
+
+'''
+EntityIndex membership and slot types against the list scans it replaced,
+in generate_template (KVR, MultiWOZ) and in candid2DL (bAbI), over every
+word of the dev files and of the entity tables themselves.
+
+Command:
+
+python -m pytest utils/utils_entity_test.py
+
+'''
+
+FILES = {
+    'kvr': 'data/KVR/dev_modified.txt',
+    'multiwoz': 'data/multiwoz/valid_modified.txt',
+    'babi': 'data/dialog-bAbI-tasks/dialog-babi-task5dev.txt'}
+CANDIDATES = 'data/dialog-bAbI-tasks/dialog-babi-candidates.txt'
+
+
+def words(file_name):
+    with open(file_name) as f:
+        return set(f.read().split())
+
+
+def scan_type(global_entity, word):
+    """The slot type generate_template found by scanning the lowercased entity lists."""
+    for key in global_entity.keys():
+        if key != 'poi':
+            values = [x.lower() for x in global_entity[key]]
+        else:
+            values = [d['poi'].lower() for d in global_entity['poi']]
+        if word in values or word.replace('_', ' ') in values:
+            return key
+    return None
+
+
+def scan_candid2DL(candid_path, kb_path, task_id):
+    """candid2DL with the per-type list scans, as candidate -> typed candidate."""
+    type_dict = get_type_dict(kb_path, dstc2=(task_id==6))
+    ent_list = [value for key in type_dict for value in type_dict[key]]
+    candidates, _, _ = load_candidates(task_id=task_id, candidates_f=candid_path)
+    candid2candDL = {}
+    for cand in candidates:
+        cand_DL = list(cand)
+        for i, word in enumerate(cand_DL):
+            if word in ent_list:
+                for type_name in type_dict:
+                    if word in type_dict[type_name] and type_name != 'R_rating':
+                        cand_DL[i] = type_name
+                        break
+        candid2candDL[' '.join(cand)] = ' '.join(cand_DL)
+    return candid2candDL
+
+
+def test_generate_template_types():
+    for dataset in ['kvr', 'multiwoz']:
+        with open(ENTITY_FILES[dataset]) as f:
+            global_entity = json.load(f)
+        index = get_entity_index(dataset)
+        vocabulary = words(FILES[dataset]) | set(w.replace(' ', '_') for w in index.type_of)
+        for word in vocabulary:
+            assert index.get(word) == scan_type(global_entity, word), (dataset, word)
+
+
+def test_babi_index():
+    type_dict = get_type_dict(ENTITY_FILES['babi'])
+    index = get_entity_index('babi')
+    for word in words(FILES['babi']) | words(ENTITY_FILES['babi']):
+        types = [key for key in type_dict if word in type_dict[key]]
+        assert (word in index) == bool(types), word
+        assert index.types(word) == types and index.get(word) == (types[0] if types else None), word
+
+    cand2DLidx, idx2candDL = candid2DL(CANDIDATES, 5)
+    expected = scan_candid2DL(CANDIDATES, ENTITY_FILES['babi'], 5)
+    assert dict((cand, idx2candDL[i]) for cand, i in cand2DLidx.items()) == expected
+
+
+if __name__=="__main__":
+    test_generate_template_types()
+    test_babi_index()
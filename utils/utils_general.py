@@ -1,7 +1,10 @@
 import torch
 import torch.utils.data as data
 import torch.nn as nn
+import numpy as np
+import os
 from utils.config import *
+from utils.utils_dialogue import MemoryView
 # import tensorflow as tf
 
 
@@ -11,6 +14,24 @@ def _cuda(x):
     else:
         return x
 
+
+def row_position(row):
+    """
+    (turn, word index + 1) of a dialogue history memory row ([word, speaker, 'turnN', 'wordI', ...]),
+    None for the KB, NULL and padding rows.
+    """
+    if len(row) > 3 and row[1] in ('$u', '$s') and row[2].startswith('turn') and row[3].startswith('word'):
+        return int(row[2][4:]), int(row[3][4:]) + 1
+    return None
+
+
+def strip_position(row):
+    """row with its turn and word tokens replaced by PAD when -pos carries them as numbers."""
+    if args['positions'] == 'token' or row_position(row) is None:
+        return row
+    return list(row[:2]) + ['PAD', 'PAD'] + list(row[4:])
+
+
 class Lang:
     def __init__(self):
         self.word2index = {}
@@ -24,7 +45,7 @@ class Lang:
                 self.index_word(word)
         else:
             for word_triple in story:
-                for word in word_triple:
+                for word in strip_position(word_triple):
                     self.index_word(word)
 
     def index_word(self, word):
@@ -33,40 +54,234 @@ class Lang:
             self.index2word[self.n_words] = word
             self.n_words += 1
 
+    def freeze(self):
+        """Returns the current words as a Vocab, with the same ids."""
+        return Vocab([self.index2word[i] for i in range(self.n_words)])
+
+
+class Vocab:
+    """
+    Frozen vocabulary. index2word is a NumPy array of the words by id and word2index its
+    inverse; words that are not in the vocabulary encode to UNK_token. Saved next to a
+    checkpoint as lang.npy with save_vocab, so inference does not rebuild it from the data.
+    """
+    def __init__(self, words):
+        self.index2word = np.empty(len(words), dtype=object)
+        self.index2word[:] = words
+        self.word2index = dict((word, i) for i, word in enumerate(words))
+        self.n_words = len(words)
+
+    def lookup(self, words):
+        """Ids of a flat list of words as an int32 array."""
+        get = self.word2index.get
+        return np.fromiter((get(word, UNK_token) for word in words), dtype=np.int32, count=len(words))
+
+    def encode_flat(self, token_lists):
+        """Ids of all token_lists concatenated into one int32 array, with the start offset of every list."""
+        offsets = np.zeros(len(token_lists) + 1, dtype=np.int64)
+        np.cumsum([len(tokens) for tokens in token_lists], out=offsets[1:])
+        return self.lookup([word for tokens in token_lists for word in tokens]), offsets
+
+    def encode(self, token_lists):
+        """Encodes every token list of token_lists to an int32 array."""
+        ids, offsets = self.encode_flat(token_lists)
+        return np.split(ids, offsets[1:-1])
+
+    def freeze(self):
+        return self
+
+
+def save_vocab(directory, lang, max_resp_len):
+    """Saves lang (frozen if needed), max_resp_len and the -pos mode to directory/lang.npy."""
+    saved = np.empty(3, dtype=object)
+    saved[0] = lang if isinstance(lang, Vocab) else lang.freeze()
+    saved[1] = max_resp_len
+    saved[2] = args['positions']
+    np.save(os.path.join(directory, 'lang.npy'), saved, allow_pickle=True)
+
+
+def load_vocab(directory):
+    """
+    Returns the (Vocab, max_resp_len) saved in directory, (None, None) if there is none.
+    The vocabulary must have been built with the current -pos mode (token before it was saved).
+    """
+    path = os.path.join(directory, 'lang.npy')
+    if not os.path.exists(path):
+        return None, None
+    saved = np.load(path, allow_pickle=True)
+    lang, max_resp_len = saved[0], saved[1]
+    check_positions(saved[2] if len(saved) > 2 else 'token', directory)
+    if isinstance(lang, Lang):
+        lang = lang.freeze()
+    return lang, int(max_resp_len)
+
+
+def check_positions(mode, source):
+    """
+    Raises ValueError if the checkpoint source was trained with another -pos mode than the
+    current one: its vocabulary and embeddings expect the positions as tokens or as numbers.
+    """
+    if mode != args['positions']:
+        raise ValueError("{} was trained with -pos={}, run it with -pos={} instead of -pos={}".format(
+            source, mode, mode, args['positions']))
+
+
+class LastPosition:
+    """
+    Incrementally maintained word -> last position index over a memory whose rows are
+    prepended (KB rows of context_arr) or appended (dialogue history), keyed on row[0].
+    """
+    def __init__(self):
+        self.n_front, self.n_back = 0, 0
+        self.front_first, self.back_last = {}, {}
+
+    def add_front(self, rows):
+        for row in reversed(rows):
+            self.front_first.setdefault(row[0], self.n_front)
+            self.n_front += 1
+
+    def add_back(self, rows):
+        for row in rows:
+            self.back_last[row[0]] = self.n_back
+            self.n_back += 1
+
+    def __len__(self):
+        return self.n_front + self.n_back
+
+    def get(self, word, default=None):
+        if word in self.back_last:
+            return self.n_front + self.back_last[word]
+        if word in self.front_first:
+            return self.n_front - 1 - self.front_first[word]
+        return default
+
+
+class Batch(dict):
+    """
+    A collated batch. context_arr is a [batch, len, MEM_TOKEN_SIZE] LongTensor, conv_arr and
+    kb_arr are [len, batch, MEM_TOKEN_SIZE], response, sketch_response and ptr_index are
+    [batch, len] LongTensors and selector_index a FloatTensor, all padded. Unless -pos=token,
+    context_arr_pos and conv_arr_pos hold the (turn, word) positions of the memory rows, laid out
+    like context_arr and conv_arr with 2 instead of MEM_TOKEN_SIZE. lm_index maps the context_arr
+    rows to the dialogue history encoder outputs (see lm_index). The *_lengths and the
+    remaining per-sample fields are lists. Fields read both as items and as attributes.
+    """
+    __slots__ = ()
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def pin_memory(self):
+        return Batch((k, v.pin_memory() if torch.is_tensor(v) else v) for k, v in self.items())
+
+    def to(self, device, non_blocking=False):
+        return Batch((k, v.to(device, non_blocking=non_blocking) if torch.is_tensor(v) else v) for k, v in self.items())
+
+
+class DevicePrefetcher:
+    """
+    Iterates a DataLoader of Batches and moves their tensors to the GPU. The copy of batch N+1 is
+    issued from pinned memory with non_blocking on a side CUDA stream before batch N is handed
+    out, so it overlaps with the computation on batch N. Without CUDA the batches pass through.
+    Everything else (len, dataset, batch_sampler) is the wrapped loader's.
+    """
+    def __init__(self, loader):
+        self.loader = loader
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __getattr__(self, name):
+        if name == 'loader':
+            raise AttributeError(name)
+        return getattr(self.loader, name)
+
+    def __iter__(self):
+        if not USE_CUDA:
+            yield from self.loader
+            return
+        stream = torch.cuda.Stream()
+        batches = iter(self.loader)
+        next_batch = self.preload(batches, stream)
+        while next_batch is not None:
+            torch.cuda.current_stream().wait_stream(stream)
+            batch = next_batch
+            for v in batch.values():
+                if torch.is_tensor(v):
+                    v.record_stream(torch.cuda.current_stream())
+            next_batch = self.preload(batches, stream)
+            yield batch
+
+    def preload(self, batches, stream):
+        try:
+            batch = next(batches)
+        except StopIteration:
+            return None
+        with torch.cuda.stream(stream):
+            return batch.pin_memory().to('cuda', non_blocking=True)
+
+
+class LazyLoader:
+    """
+    The get_seq loader over the samples of a LazySplit, built the first time it is iterated
+    or any loader attribute (len, dataset, batch_sampler) is read. A run that never evaluates
+    on a split never loads it.
+    """
+    def __init__(self, split, lang, batch_size):
+        self.split = split
+        self.lang = lang
+        self.batch_size = batch_size
+        self.loader = None
+
+    def load(self):
+        if self.loader is None:
+            self.loader = get_seq(self.split.pairs(), self.lang, self.batch_size, False)
+        return self.loader
+
+    def __len__(self):
+        return len(self.load())
+
+    def __iter__(self):
+        return iter(self.load())
+
+    def __getattr__(self, name):
+        if name in ('split', 'lang', 'batch_size', 'loader'):
+            raise AttributeError(name)
+        return getattr(self.load(), name)
+
 
 class Dataset(data.Dataset):
     """Custom data.Dataset compatible with data.DataLoader."""
-    def __init__(self, data_info, src_word2id, trg_word2id):
-        """Reads source and target sequences from txt files."""
+    def __init__(self, data_info, vocab):
+        """Encodes the memory, response and label fields to int32 arrays once with the Vocab vocab."""
         self.data_info = {}
         for k in data_info.keys():
             self.data_info[k] = data_info[k]
 
         self.num_total_seqs = len(data_info['context_arr'])
-        self.src_word2id = src_word2id
-        self.trg_word2id = trg_word2id
+        self.vocab = vocab
+        self.encode_memories(['context_arr', 'conv_arr', 'kb_arr'])
+        self.encoded = {}
+        for k in ['response', 'sketch_response']:
+            ids, offsets = vocab.encode_flat([seq.split(' ') + ['EOS'] for seq in self.data_info[k]])
+            self.encoded[k] = np.append(ids, np.int32(PAD_token)), offsets
+        self.encoded['ptr_index'] = self.encode_sequences(self.data_info['ptr_index'], np.int32, PAD_token)
+        self.encoded['selector_index'] = self.encode_sequences(self.data_info['selector_index'], np.float32, 0)
+        self.buffers = {}
     
     def __getitem__(self, index):
         """Returns one data pair (source and target)."""
-        context_arr = self.data_info['context_arr'][index]
-        context_arr = self.preprocess(context_arr, self.src_word2id, trg=False)
-        response = self.data_info['response'][index]
-        response = self.preprocess(response, self.trg_word2id)
-        ptr_index = torch.Tensor(self.data_info['ptr_index'][index])
-        selector_index = torch.Tensor(self.data_info['selector_index'][index])
-        conv_arr = self.data_info['conv_arr'][index]
-        conv_arr = self.preprocess(conv_arr, self.src_word2id, trg=False)
-        kb_arr = self.data_info['kb_arr'][index]
-        kb_arr = self.preprocess(kb_arr, self.src_word2id, trg=False)
-        sketch_response = self.data_info['sketch_response'][index]
-        sketch_response = self.preprocess(sketch_response, self.trg_word2id)
-        
         # processed information
         data_info = {}
         for k in self.data_info.keys():
-            try:
-                data_info[k] = locals()[k]
-            except:
+            if k in self.memory_spans:
+                data_info[k] = self.memory_slice(k, index)
+            elif k in self.encoded:
+                data_info[k] = self.sequence_slice(k, index)
+            else:
                 data_info[k] = self.data_info[k][index]
 
         # additional plain information
@@ -78,85 +293,259 @@ class Dataset(data.Dataset):
 
     def __len__(self):
         return self.num_total_seqs
+
+    def __getitems__(self, indices):
+        """Batched fetch used by the DataLoader: collate_fn works on the sample indices directly."""
+        return list(indices)
     
-    def preprocess(self, sequence, word2id, trg=True):
-        """Converts words to ids."""
-        if trg:
-            story = [word2id[word] if word in word2id else UNK_token for word in sequence.split(' ')]+ [EOS_token]
-        else:
-            story = []
-            for i, word_triple in enumerate(sequence):
-                story.append([])
-                for ii, word in enumerate(word_triple):
-                    temp = word2id[word] if word in word2id else UNK_token
-                    story[i].append(temp)
-        story = torch.Tensor(story)
-        return story
-
-    def collate_fn(self, data):
-        def merge(sequences,story_dim):
-            lengths = [len(seq) for seq in sequences]
-            max_len = 1 if max(lengths)==0 else max(lengths)
-            if (story_dim):
-                padded_seqs = torch.ones(len(sequences), max_len, MEM_TOKEN_SIZE).long()
-                for i, seq in enumerate(sequences):
-                    end = lengths[i]
-                    if len(seq) != 0:
-                        padded_seqs[i,:end,:] = seq[:end]
+    def encode_memories(self, fields):
+        """
+        Encodes the memory rows of every dialogue once into self.memory_rows and keeps a
+        (start, stop, null) span per sample and field. A DialogueMemory is laid out as its KB rows,
+        the KB rows reversed and the dialogue history, so every MemoryView is one contiguous
+        slice plus the optional NULL row. Samples holding plain lists get a block of their own.
+        """
+        blocks, bases, n_rows = [], {}, 0
+        self.memory_spans = {}
+        for k in fields:
+            spans = []
+            for seq in self.data_info[k]:
+                memory = seq.memory if isinstance(seq, MemoryView) else seq
+                if id(memory) not in bases:
+                    if isinstance(seq, MemoryView):
+                        rows = memory.kb + memory.kb[::-1] + memory.conv
+                    else:
+                        rows = list(seq)
+                    bases[id(memory)] = n_rows
+                    blocks.append(rows)
+                    n_rows += len(rows)
+                base = bases[id(memory)]
+                if not isinstance(seq, MemoryView):
+                    spans.append((base, base + len(seq), 0))
+                elif seq.reverse_kb:
+                    n_kb = len(memory.kb)
+                    spans.append((base + 2*n_kb - seq.n_kb, base + 2*n_kb + seq.n_conv, seq.null))
+                elif seq.n_conv:
+                    spans.append((base + 2*len(memory.kb), base + 2*len(memory.kb) + seq.n_conv, seq.null))
+                else:
+                    spans.append((base, base + seq.n_kb, seq.null))
+            self.memory_spans[k] = np.array(spans, dtype=np.int64).reshape(-1, 3)
+        # the NULL row and the padding row follow the dialogue rows
+        blocks.append([['$$$$']*MEM_TOKEN_SIZE, ['PAD']*MEM_TOKEN_SIZE])
+        self.null_row_id, self.pad_row_id = n_rows, n_rows + 1
+        if args['positions'] != 'token':
+            # turn and word positions become a side channel, 0 for the rows without one
+            positions = [row_position(row) or (0, 0) for block in blocks for row in block]
+            self.memory_positions = np.array(positions, dtype=np.int32).reshape(-1, 2)
+            blocks = [[strip_position(row) for row in block] for block in blocks]
+        words = [word for block in blocks for row in block for word in row]
+        self.memory_rows = self.vocab.lookup(words).reshape(-1, MEM_TOKEN_SIZE)
+
+    def encode_sequences(self, sequences, dtype, pad):
+        """
+        Concatenates sequences into one array of dtype, followed by the padding value pad.
+        Returned with the start offset of every sequence.
+        """
+        lengths = [len(seq) for seq in sequences]
+        offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        return np.array([x for seq in sequences for x in seq] + [pad], dtype=dtype), offsets
+
+    def memory_slice(self, k, index):
+        start, stop, null = self.memory_spans[k][index]
+        rows = self.memory_rows[start:stop]
+        if null:
+            rows = np.concatenate([rows, self.memory_rows[self.null_row_id:self.null_row_id+1]])
+        return torch.from_numpy(rows)
+
+    def lengths(self, k):
+        """Number of rows of memory field k of every sample, NULL row included."""
+        spans = self.memory_spans[k]
+        return spans[:, 1] - spans[:, 0] + spans[:, 2]
+
+    def sequence_slice(self, k, index):
+        values, offsets = self.encoded[k]
+        return torch.from_numpy(values[offsets[index]:offsets[index+1]])
+
+    def buffer(self, name, shape, dtype):
+        """Preallocated staging array of at least shape, reused across batches and grown on demand."""
+        size = int(np.prod(shape))
+        buf = self.buffers.get(name)
+        if buf is None or buf.size < size:
+            buf = np.empty(max(size, 2*buf.size if buf is not None else size), dtype=dtype)
+            self.buffers[name] = buf
+        return buf[:size].reshape(shape)
+
+    def memory_gather(self, k, indices):
+        """[batch, len] ids in memory_rows of the padded memory k of samples indices, and its lengths."""
+        spans = self.memory_spans[k][indices]
+        n_rows = spans[:, 1] - spans[:, 0]
+        lengths = n_rows + spans[:, 2]
+        max_len = max(int(lengths.max()), 1)
+        positions = np.arange(max_len)
+        gather = np.where(positions < n_rows[:, None], spans[:, :1] + positions, self.pad_row_id)
+        null = spans[:, 2].astype(bool)
+        gather[null, n_rows[null]] = self.null_row_id
+        return gather, lengths
+
+    def merge_memory(self, k, indices):
+        """Pads the memory rows of samples indices into a [batch, len, MEM_TOKEN_SIZE] LongTensor."""
+        gather, lengths = self.memory_gather(k, indices)
+        padded = self.buffer(k, gather.shape + (MEM_TOKEN_SIZE,), np.int32)
+        np.take(self.memory_rows, gather, axis=0, out=padded)
+        return torch.from_numpy(padded).long(), lengths.tolist()
+
+    def merge_positions(self, k, indices):
+        """The (turn, word) positions of the rows of merge_memory, a [batch, len, 2] LongTensor."""
+        gather, _ = self.memory_gather(k, indices)
+        return torch.from_numpy(np.take(self.memory_positions, gather, axis=0)).long()
+
+    def merge_sequence(self, k, indices):
+        """Pads the encoded sequences k of samples indices into a [batch, len] tensor."""
+        values, offsets = self.encoded[k]
+        starts = offsets[indices]
+        lengths = offsets[indices + 1] - starts
+        max_len = max(int(lengths.max()), 1)
+        positions = np.arange(max_len)
+        gather = np.where(positions < lengths[:, None], starts[:, None] + positions, len(values) - 1)
+        padded = self.buffer(k, (len(indices), max_len), values.dtype)
+        np.take(values, gather, out=padded)
+        if values.dtype == np.float32:
+            return torch.from_numpy(padded.copy()), lengths.tolist()
+        return torch.from_numpy(padded).long(), lengths.tolist()
+
+    def collate_fn(self, indices):
+        """Collates the samples indices (from __getitems__) into a Batch."""
+        indices = np.asarray(indices, dtype=np.int64)
+        # sort by sequence length (descending order, stable) to use pack_padded_sequence
+        conv_spans = self.memory_spans['conv_arr'][indices]
+        order = np.argsort(-(conv_spans[:, 1] - conv_spans[:, 0] + conv_spans[:, 2]), kind='stable')
+        indices = indices[order]
+
+        batch = Batch()
+        for k in self.data_info.keys():
+            if k in self.memory_spans:
+                batch[k], batch[k+'_lengths'] = self.merge_memory(k, indices)
+            elif k in self.encoded:
+                batch[k], lengths = self.merge_sequence(k, indices)
+                if k == 'response':
+                    batch['response_lengths'] = lengths
             else:
-                padded_seqs = torch.ones(len(sequences), max_len).long()
-                for i, seq in enumerate(sequences):
-                    end = lengths[i]
-                    padded_seqs[i, :end] = seq[:end]
-            return padded_seqs, lengths
-
-        def merge_index(sequences):
-            lengths = [len(seq) for seq in sequences]
-            padded_seqs = torch.zeros(len(sequences), max(lengths)).float()
-            for i, seq in enumerate(sequences):
-                end = lengths[i]
-                padded_seqs[i, :end] = seq[:end]    
-            return padded_seqs, lengths
-        
-        # sort a list by sequence length (descending order) to use pack_padded_sequence
-        data.sort(key=lambda x: len(x['conv_arr']), reverse=True) 
-        item_info = {}
-        for key in data[0].keys():
-            item_info[key] = [d[key] for d in data]
-
-        # merge sequences 
-        context_arr, context_arr_lengths = merge(item_info['context_arr'], True)
-        response, response_lengths = merge(item_info['response'], False)
-        selector_index, _ = merge_index(item_info['selector_index'])
-        ptr_index, _ = merge(item_info['ptr_index'], False)
-        conv_arr, conv_arr_lengths = merge(item_info['conv_arr'], True)
-        sketch_response, _ = merge(item_info['sketch_response'], False)
-        kb_arr, kb_arr_lengths = merge(item_info['kb_arr'], True)
-        
-        # convert to contiguous and cuda
-        context_arr = _cuda(context_arr.contiguous())
-        response = _cuda(response.contiguous())
-        selector_index = _cuda(selector_index.contiguous())
-        ptr_index = _cuda(ptr_index.contiguous())
-        conv_arr = _cuda(conv_arr.transpose(0,1).contiguous())
-        sketch_response = _cuda(sketch_response.contiguous())
-        if(len(list(kb_arr.size()))>1): kb_arr = _cuda(kb_arr.transpose(0,1).contiguous())
-        
-        # processed information
-        data_info = {}
-        for k in item_info.keys():
-            try:
-                data_info[k] = locals()[k]
-            except:
-                data_info[k] = item_info[k]
+                batch[k] = [self.data_info[k][i] for i in indices]
+
+        # convert to contiguous, the transfer to the GPU is left to DevicePrefetcher
+        batch['conv_arr'] = batch['conv_arr'].transpose(0,1).contiguous()
+        batch['kb_arr'] = batch['kb_arr'].transpose(0,1).contiguous()
+        batch['lm_index'] = lm_index(batch['kb_arr_lengths'], batch['conv_arr_lengths'],
+                                     batch['context_arr'].size(1), batch['conv_arr'].size(0))
+        if args['positions'] != 'token':
+            batch['context_arr_pos'] = self.merge_positions('context_arr', indices)
+            batch['conv_arr_pos'] = self.merge_positions('conv_arr', indices).transpose(0,1).contiguous()
 
         # additional plain information
-        data_info['context_arr_lengths'] = context_arr_lengths
-        data_info['response_lengths'] = response_lengths
-        data_info['conv_arr_lengths'] = conv_arr_lengths
-        data_info['kb_arr_lengths'] = kb_arr_lengths
+        batch['context_arr_plain'] = [self.data_info['context_arr'][i] for i in indices]
+        batch['response_plain'] = [self.data_info['response'][i] for i in indices]
+        batch['kb_arr_plain'] = [self.data_info['kb_arr'][i] for i in indices]
 
-        return data_info
+        return batch
+
+
+def lm_index(kb_len, conv_len, memory_len, conv_max_len):
+    """
+    [batch, memory_len] LongTensor of the row of the flattened [batch * conv_max_len] dialogue
+    history encoder outputs that ExternalKnowledge adds to every context_arr row: rows
+    kb_len .. kb_len+conv_len-1 of sample b take outputs b*conv_max_len + 0, 1, ..., and the
+    others the zero row batch*conv_max_len appended after them.
+    """
+    kb_len = np.asarray(kb_len, dtype=np.int64)[:, None]
+    conv_len = np.asarray(conv_len, dtype=np.int64)[:, None]
+    step = np.arange(memory_len)[None, :] - kb_len
+    rows = np.arange(len(kb_len))[:, None] * conv_max_len + step
+    zero = len(kb_len) * conv_max_len
+    return torch.from_numpy(np.where((step >= 0) & (step < conv_len), rows, zero))
+
+
+class BucketBatchSampler(data.Sampler):
+    """
+    Batches of sample indices drawn from n_buckets buckets of similar length (samples sorted
+    by length and split into equal-size buckets). With shuffle, samples are shuffled within
+    their bucket and the batches across buckets every epoch. n_buckets=0 keeps the file order.
+
+    With token_budget > 0, batch_size is ignored: the samples of a bucket (all of them with
+    n_buckets=0) are sorted by length and batches are filled while batch size x longest length x
+    MEM_TOKEN_SIZE stays within token_budget. len() is the number of batches of the next epoch,
+    drawn when it is first asked for. efficiency is the real / padded tokens of the batches of
+    the last epoch.
+    """
+    def __init__(self, lengths, batch_size, n_buckets=0, shuffle=False, token_budget=0):
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.batch_size = batch_size
+        self.token_budget = token_budget
+        self.shuffle = shuffle and n_buckets > 0
+        if n_buckets > 0:
+            order = np.argsort(self.lengths, kind='stable')
+            self.buckets = [b for b in np.array_split(order, min(n_buckets, len(order))) if len(b)]
+        else:
+            self.buckets = [np.arange(len(self.lengths))]
+        self.next_batches = None
+        self.efficiency = None
+
+    def split(self, bucket):
+        """Cuts the samples of a bucket into batches."""
+        if self.token_budget <= 0:
+            return [bucket[i:i+self.batch_size] for i in range(0, len(bucket), self.batch_size)]
+        bucket = bucket[np.argsort(self.lengths[bucket], kind='stable')]
+        batches, start, max_len = [], 0, 0
+        for i, length in enumerate(self.lengths[bucket].tolist()):
+            max_len = max(max_len, length)
+            if i > start and (i - start + 1) * max_len * MEM_TOKEN_SIZE > self.token_budget:
+                batches.append(bucket[start:i])
+                start, max_len = i, length
+        if start < len(bucket):
+            batches.append(bucket[start:])
+        return batches
+
+    def batches(self):
+        batches = []
+        for bucket in self.buckets:
+            if self.shuffle:
+                bucket = np.random.permutation(bucket)
+            batches += self.split(bucket)
+        if self.shuffle:
+            batches = [batches[i] for i in np.random.permutation(len(batches))]
+        return batches
+
+    def __iter__(self):
+        batches = self.next_batches if self.next_batches is not None else self.batches()
+        self.next_batches = None
+        self.efficiency = padding_efficiency(self.lengths, batches)
+        for batch in batches:
+            yield batch.tolist()
+
+    def __len__(self):
+        if self.next_batches is None:
+            self.next_batches = self.batches()
+        return len(self.next_batches)
+
+
+def token_budget_buckets(lengths, token_budget, n_buckets):
+    """
+    Boundaries of n_buckets length buckets at the quantiles of lengths, and for every bucket the
+    batch size keeping batch size x longest length x MEM_TOKEN_SIZE within token_budget.
+    Bucket i holds the lengths in [boundaries[i-1], boundaries[i]).
+    """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    quantiles = np.quantile(lengths, np.linspace(0, 1, n_buckets + 1)[1:-1])
+    boundaries = sorted(set(int(q) + 1 for q in quantiles))
+    upper = boundaries + [int(lengths.max()) + 1]
+    batch_sizes = [max(1, token_budget // ((u - 1) * MEM_TOKEN_SIZE)) for u in upper]
+    return boundaries, batch_sizes
+
+
+def padding_efficiency(lengths, batches):
+    """Real tokens / padded tokens of batches padded to their longest sample."""
+    real = sum(int(lengths[batch].sum()) for batch in batches)
+    padded = sum(len(batch) * int(lengths[batch].max()) for batch in batches)
+    return real / float(max(padded, 1))
 
 
 def get_seq(pairs, lang, batch_size, type):   
@@ -167,18 +556,20 @@ def get_seq(pairs, lang, batch_size, type):
     for pair in pairs:
         for k in pair.keys():
             data_info[k].append(pair[k])
-        if(type):
+        if(type) and isinstance(lang, Lang):
             lang.index_words(pair['context_arr'])
             lang.index_words(pair['response'], trg=True)
             lang.index_words(pair['sketch_response'], trg=True)
     
-    dataset = Dataset(data_info, lang.word2index, lang.word2index)
+    dataset = Dataset(data_info, lang if isinstance(lang, Vocab) else lang.freeze())
+    batch_sampler = BucketBatchSampler(dataset.lengths('context_arr'), batch_size, args['buckets'], shuffle=type,
+                                       token_budget=args['token_budget'])
     data_loader = torch.utils.data.DataLoader(dataset = dataset,
-                                              batch_size = batch_size,
-                                              # shuffle = type,
-                                              shuffle = False,
-                                              collate_fn = dataset.collate_fn)
-    return data_loader
+                                              batch_sampler = batch_sampler,
+                                              collate_fn = dataset.collate_fn,
+                                              num_workers = args['num_workers'],
+                                              persistent_workers = args['num_workers'] > 0)
+    return DevicePrefetcher(data_loader)
 
 
 def compute_dataset_length(data_length, batch_size):
@@ -0,0 +1,168 @@
+import sys
+sys.argv = sys.argv[:1] + ['-ds=kvr']  # utils.config parses the command line on import
+
+import os
+import tempfile
+from utils.config import *
+import torch
+import numpy as np
+from utils.utils_general import Lang, Vocab, Dataset, DevicePrefetcher, get_seq, BucketBatchSampler, token_budget_buckets, padding_efficiency, save_vocab, load_vocab, row_position, lm_index
+from utils.utils_dialogue import DialogueMemory
+
+'''
+A frozen Vocab keeps the ids of the Lang it comes from, encodes in bulk to
+int32 arrays and round-trips through the lang.npy saved next to a checkpoint,
+which refuses to load under another -pos mode than the one it was built with.
+With -pos, the turn and word tokens of the dialogue history leave the
+vocabulary and reach the batch as numbers. lm_index places the history
+encoder outputs on the memory rows like the per-sample slicing it replaced.
+BucketBatchSampler yields every sample once per epoch, within the token
+budget, as many batches as len() says; token-budget batches are packed in
+length order, also from a single shuffled bucket. DevicePrefetcher hands
+out the batches of its DataLoader, in order and with every key.
+
+Command:
+
+python -m pytest utils/utils_general_test.py
+
+'''
+
+
+def test_vocab():
+    lang = Lang()
+    lang.index_words([['hello', 'world', 'PAD'], ['world', '$u', 'turn1']])
+    vocab = lang.freeze()
+    assert vocab.n_words == lang.n_words
+    assert [vocab.index2word[i] for i in range(vocab.n_words)] == [lang.index2word[i] for i in range(lang.n_words)]
+
+    ids = vocab.encode([['hello', 'unseen'], [], ['EOS', 'world']])
+    assert [a.tolist() for a in ids] == [[lang.word2index['hello'], UNK_token], [], [EOS_token, lang.word2index['world']]]
+    assert all(a.dtype.name == 'int32' for a in ids)
+
+    with tempfile.TemporaryDirectory() as directory, tempfile.TemporaryDirectory() as empty:
+        save_vocab(directory, lang, 17)
+        loaded, max_resp_len = load_vocab(directory)
+        assert isinstance(loaded, Vocab) and max_resp_len == 17
+        assert loaded.word2index == lang.word2index
+        assert load_vocab(empty) == (None, None)
+
+        # the -pos mode is saved with the vocabulary and must match when it is loaded
+        args['positions'] = 'learned'
+        try:
+            save_vocab(directory, lang, 17)
+            assert load_vocab(directory)[1] == 17
+        finally:
+            args['positions'] = 'token'
+        try:
+            load_vocab(directory)
+            assert False, 'a -pos=learned vocabulary loaded with -pos=token'
+        except ValueError as e:
+            assert '-pos=learned' in str(e)
+        # vocabularies saved before the mode was are token ones
+        np.save(os.path.join(empty, 'lang.npy'), np.array([vocab, 17], dtype=object), allow_pickle=True)
+        assert load_vocab(empty)[1] == 17
+
+
+def test_position_side_channel():
+    def history(words, speaker, turn):
+        return [[w, speaker, 'turn'+str(turn), 'word'+str(i)] + ['PAD']*(MEM_TOKEN_SIZE-4) for i, w in enumerate(words)]
+
+    memory = DialogueMemory()
+    memory.add_kb([['b', 'a'] + ['PAD']*(MEM_TOKEN_SIZE-2)])
+    memory.add_conv(history(['hi', 'there'], '$u', 1))
+    pair = {'context_arr':memory.context_arr(), 'conv_arr':memory.conv_arr(), 'kb_arr':memory.kb_arr(null=True),
+            'response':'hello b', 'sketch_response':'hello @a', 'ptr_index':[3, 0, 3], 'selector_index':[1, 0, 0, 1]}
+
+    args['positions'] = 'learned'
+    try:
+        lang = Lang()
+        lang.index_words(pair['context_arr'])
+        assert not any(w.startswith('turn') or w.startswith('word') for w in lang.word2index)
+        lang.index_words(pair['response'], trg=True)
+        lang.index_words(pair['sketch_response'], trg=True)
+        dataset = Dataset(dict((k, [v]) for k, v in pair.items()), lang.freeze())
+        batch = dataset.collate_fn([0])
+    finally:
+        args['positions'] = 'token'
+    positions = [row_position(row) or (0, 0) for row in pair['context_arr']]
+    assert batch['context_arr_pos'][0].tolist() == [list(p) for p in positions] == [[0, 0], [1, 1], [1, 2], [0, 0]]
+    assert batch['conv_arr_pos'][:, 0].tolist() == [[1, 1], [1, 2]]
+    assert (batch['context_arr'][0, 1:3, 2:4] == PAD_token).all()
+
+
+def test_device_prefetcher():
+    from utils.utils_testing import build_lang
+    import utils.utils_Ent_kvr as kvr
+    from utils.utils_cache import read_langs_cached
+    pairs, _ = read_langs_cached(kvr.read_langs, 'data/KVR/dev_modified.txt', ['data/KVR/kvret_entities.json'])
+    args['positions'], args['num_workers'] = 'learned', 1
+    try:
+        loader = get_seq(pairs[:200], build_lang(pairs[:200]), 16, False)
+        assert isinstance(loader, DevicePrefetcher) and len(loader) == len(loader.loader)
+        plain = list(loader.loader)
+        prefetched = list(loader)
+    finally:
+        args['positions'], args['num_workers'] = 'token', 0
+    assert len(prefetched) == len(plain) == len(loader)
+    for a, b in zip(plain, prefetched):
+        assert a.keys() == b.keys() and 'lm_index' in b and 'context_arr_pos' in b and 'conv_arr_pos' in b
+        for k in a:
+            assert torch.equal(a[k], b[k]) if torch.is_tensor(a[k]) else a[k] == b[k], k
+
+
+def test_lm_index():
+    kb_len, conv_len, memory_len = [3, 0, 5], [4, 2, 1], 8
+    hiddens = torch.randn(3, 4, 5)
+    expected = torch.zeros(3, memory_len, 5)
+    for bi in range(3):
+        expected[bi, kb_len[bi]:kb_len[bi]+conv_len[bi]] = hiddens[bi, :conv_len[bi]]
+    rows = torch.cat([hiddens.reshape(-1, 5), torch.zeros(1, 5)])
+    assert torch.equal(rows[lm_index(kb_len, conv_len, memory_len, 4)], expected)
+
+
+def test_bucket_batch_sampler():
+    lengths = np.random.RandomState(1).randint(1, 80, 300)
+    budget = 50 * MEM_TOKEN_SIZE * 3
+    for n_buckets, shuffle, token_budget in [(0, False, 0), (4, True, 0), (0, False, budget), (5, True, budget)]:
+        sampler = BucketBatchSampler(lengths, 16, n_buckets, shuffle=shuffle, token_budget=token_budget)
+        for _ in range(2):
+            n_batches = len(sampler)
+            batches = list(sampler)
+            assert len(batches) == n_batches
+            assert sorted(i for b in batches for i in b) == list(range(len(lengths)))
+            assert 0 < sampler.efficiency <= 1
+            for b in batches:
+                if token_budget:
+                    assert len(b) == 1 or len(b) * lengths[b].max() * MEM_TOKEN_SIZE <= token_budget
+                else:
+                    assert len(b) <= 16
+    assert BucketBatchSampler(lengths, 16).batches()[0].tolist() == list(range(16))
+
+    boundaries, batch_sizes = token_budget_buckets(lengths, budget, 4)
+    upper = boundaries + [int(lengths.max()) + 1]
+    assert boundaries == sorted(boundaries) and len(batch_sizes) == len(upper)
+    assert all(size * (u - 1) * MEM_TOKEN_SIZE <= budget for size, u in zip(batch_sizes, upper))
+    assert padding_efficiency(np.array([2, 4, 3]), [np.array([0, 1]), np.array([2])]) == 9 / 11.0
+
+
+def test_token_budget_single_bucket():
+    lengths = np.random.RandomState(0).randint(1, 60, 500)
+    budget = 40 * MEM_TOKEN_SIZE * 4
+    sampler = BucketBatchSampler(lengths, 32, n_buckets=1, shuffle=True, token_budget=budget)
+    for _ in range(3):
+        n_batches = len(sampler)
+        batches = list(sampler)
+        assert len(batches) == n_batches
+        # packed in length order: every batch covers a contiguous range of the sorted lengths
+        ranges = sorted((lengths[b].min(), lengths[b].max()) for b in batches)
+        assert all(hi <= next_lo for (_, hi), (next_lo, _) in zip(ranges, ranges[1:]))
+        assert all(len(b) == 1 or len(b) * lengths[b].max() * MEM_TOKEN_SIZE <= budget for b in batches)
+
+
+if __name__=="__main__":
+    test_vocab()
+    test_position_side_channel()
+    test_device_prefetcher()
+    test_lm_index()
+    test_bucket_batch_sampler()
+    test_token_budget_single_bucket()
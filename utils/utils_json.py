@@ -0,0 +1,179 @@
+import re
+import json
+from utils.config import *
+from utils.utils_entity import get_entity_index
+
+'''
+Streaming conversion of the raw KVRET json files (kvret_*_public.json) into the
+line format of the converted KVR text files, so read_langs parses and caches
+them like any other split.
+
+The top-level json array is decoded one dialogue at a time with raw_decode
+over a growing text buffer, so memory stays flat whatever the size of the
+corpus. open_dialogues opens .json files through JsonDialogues.
+
+Utterances are lower-cased, split from their punctuation, and the multi-word
+entity values of kvret_entities.json and of the dialogue KB are joined with
+underscores. The gold entities of a response are its words that are entities,
+or KB values for the calendar and POI domains.
+'''
+
+_phrases = {}
+
+
+class JsonDialogues:
+    """Lines of the raw json file file_name in the text format, for line iteration like a file."""
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.f = open(file_name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.f.close()
+
+    def __iter__(self):
+        for dialogue in iter_json_array(self.f):
+            if 'scenario' not in dialogue:
+                raise ValueError("{} is not a KVRET json file".format(self.file_name))
+            for line in kvret_lines(dialogue):
+                yield line + '\n'
+            yield '\n'
+
+
+def iter_json_array(f, block_size=1 << 16):
+    """Yields the items of the top-level json array of the text file f one at a time."""
+    decoder = json.JSONDecoder()
+    buf, pos, eof = '', 0, False
+
+    def fill(buf, pos):
+        block = f.read(block_size)
+        return buf[pos:] + block, 0, not block
+
+    while not eof and '[' not in buf:
+        buf, pos, eof = fill(buf, pos)
+    if '[' not in buf:
+        raise ValueError("expected a json array")
+    pos = buf.index('[') + 1
+    while True:
+        # skip the separators before the next item
+        while True:
+            while pos < len(buf) and (buf[pos].isspace() or buf[pos] == ','):
+                pos += 1
+            if pos < len(buf) or eof:
+                break
+            buf, pos, eof = fill(buf, pos)
+        if pos == len(buf) or buf[pos] == ']':
+            return
+        try:
+            item, end = decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            buf, pos, eof = fill(buf, pos)
+            continue
+        if end == len(buf) and not eof:
+            # a number could continue in the next block
+            buf, pos, eof = fill(buf, pos)
+            continue
+        yield item
+        pos = end
+
+
+def entity_phrases():
+    """Multi-word KVR entity values as token tuples, from the entity index."""
+    if 'kvr' not in _phrases:
+        index = get_entity_index('kvr')
+        _phrases['kvr'] = set(tuple(value.split()) for value in index.type_of if ' ' in value)
+    return _phrases['kvr']
+
+
+def normalize(text, phrases=()):
+    """Lower-cased, tokenized text with the multi-word values of phrases joined by underscores."""
+    text = text.lower().replace("'re ", " are ").replace("'m ", " am ").replace("'", " ")
+    text = re.sub(r'(\d+) ?(am|pm)\b', r'\1\2', text)
+    text = re.sub(r'(\d+)f? ?- ?(\d+)f\b', r'\1f - \2f', text)
+    text = re.sub(r'\bthe (\d+(st|nd|rd|th))\b', r'the_\1', text)
+    text = re.sub(r'([,?!;:])', r' \1 ', text)
+    text = re.sub(r'\.(?=\s|$)', ' ', text)
+    tokens = text.split()
+    if not phrases:
+        return tokens
+    max_len = max(len(p) for p in phrases)
+    joined, i = [], 0
+    while i < len(tokens):
+        for n in range(min(max_len, len(tokens) - i), 1, -1):
+            if tuple(tokens[i:i+n]) in phrases:
+                joined.append('_'.join(tokens[i:i+n]))
+                i += n
+                break
+        else:
+            joined.append(tokens[i])
+            i += 1
+    return joined
+
+
+def value(text):
+    return '_'.join(normalize(text))
+
+
+def kvret_kb_rows(domain, items, column_names):
+    """KB rows of one dialogue, the last token of a row being the value it holds."""
+    rows = []
+    for item in items or []:
+        if domain == 'weather':
+            if not rows and item.get('today'):
+                rows.append(['today', value(item['today'])])
+            location = value(item['location'])
+            for day in column_names:
+                if day in ('location', 'today') or not item.get(day):
+                    continue
+                forecast = [part.strip() for part in item[day].split(',')]
+                rows.append([location, day, value(forecast[0])])
+                for part in forecast[1:]:
+                    level, _, temperature = part.partition(' of ')
+                    rows.append([location, day, value(level), value(temperature)])
+        elif domain == 'navigate':
+            poi = value(item['poi'])
+            rows.append([value(item['distance']), value(item['traffic_info']), value(item['poi_type']), 'poi', poi])
+            for column in ['distance', 'traffic_info', 'poi_type', 'address']:
+                rows.append([poi, column, value(item[column])])
+        else:
+            event = value(item['event'])
+            for column in column_names:
+                if column != 'event' and item.get(column, '-') != '-':
+                    rows.append([event, column, value(item[column])])
+    return rows
+
+
+def kvret_lines(dialogue):
+    """One raw KVRET dialogue as the lines of a converted KVR text file."""
+    scenario = dialogue['scenario']
+    domain = scenario['task']['intent']
+    rows = kvret_kb_rows(domain, scenario['kb']['items'], scenario['kb']['column_names'])
+
+    global_entity = get_entity_index('kvr')
+    kb_values = set(row[-1] for row in rows) if domain != 'weather' else set()
+    phrases = entity_phrases() | set(tuple(v.split('_')) for row in rows for v in row if '_' in v)
+
+    lines = ['#{}#'.format(domain)] + ['0 ' + ' '.join(row) for row in rows]
+    # consecutive turns of the same speaker are merged, the assistant opening a dialogue is dropped
+    turns = []
+    for turn in dialogue['dialogue']:
+        speaker, utterance = turn['turn'], turn['data']['utterance']
+        if turns and turns[-1][0] == speaker:
+            turns[-1][1] += ' ' + utterance
+        elif turns or speaker == 'driver':
+            turns.append([speaker, utterance])
+    for nid, i in enumerate(range(0, len(turns) - 1, 2), 1):
+        u = normalize(turns[i][1], phrases)
+        r = normalize(turns[i+1][1], phrases)
+        if not u or not r:
+            continue
+        gold_ent = []
+        for word in r:
+            if (word in global_entity or word in kb_values) and word not in gold_ent:
+                gold_ent.append(word)
+        lines.append('{} {}\t{}\t{}'.format(nid, ' '.join(u), ' '.join(r), gold_ent))
+    return lines
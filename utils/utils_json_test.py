@@ -0,0 +1,77 @@
+import sys
+sys.argv = sys.argv[:1] + ['-ds=kvr']  # utils.config parses the command line on import
+
+import io
+import json
+from utils.config import *
+import utils.utils_Ent_kvr as kvr
+from utils.utils_json import iter_json_array, normalize
+from utils.utils_dialogue import read_langs_parallel
+
+'''
+The raw json stream yields the items json.load reads, whatever the block
+size, and the raw KVRET files parse into samples like the converted files,
+every gold entity of a response typed in its sketch. -raw names the missing
+files of the KVRET release instead of failing on the first open.
+
+Command:
+
+python -m pytest utils/utils_json_test.py
+
+'''
+
+
+def test_iter_json_array():
+    items = [{'a': [1, 2.5, None]}, 12345, "x, ]", [], {'b': {'c': 'd'}}]
+    text = '  ' + json.dumps(items, indent=1)
+    for block_size in [1, 2, 7, 1 << 16]:
+        assert list(iter_json_array(io.StringIO(text), block_size)) == items
+    assert list(iter_json_array(io.StringIO('[]'))) == []
+
+
+def test_normalize():
+    assert normalize("You're welcome, it's at 3 PM on the 12th.") == ['you', 'are', 'welcome', ',', 'it', 's', 'at', '3pm', 'on', 'the_12th']
+    assert normalize('Drive to Palo Alto Garage R?', {('palo', 'alto', 'garage', 'r')}) == ['drive', 'to', 'palo_alto_garage_r', '?']
+
+
+def test_read_kvret_json():
+    file_name = 'data/KVR/kvret_dev_public.json'
+    pairs, max_resp_len = kvr.read_langs(file_name)
+    assert len(pairs) > 700 and max_resp_len > 0
+    slot_types = set(json.load(open('data/KVR/kvret_entities.json')).keys())
+    n_entities = 0
+    for pair in pairs:
+        assert pair['domain'] in ('schedule', 'weather', 'navigate')
+        sketch = pair['sketch_response'].split()
+        response = pair['response'].split()
+        assert len(sketch) == len(response)
+        kb_types = set(row[1] for row in pair['kb_arr'])
+        for word, token in zip(response, sketch):
+            if word in pair['ent_index']:
+                assert token[0] == '@' and token[1:] in slot_types | kb_types, (word, token)
+                n_entities += 1
+            else:
+                assert token == word
+    assert n_entities > 0
+    # json files are parsed in one piece by the process pool
+    (parallel_pairs, parallel_max_resp_len), = read_langs_parallel(kvr.read_langs, [file_name], (), 2)
+    assert parallel_max_resp_len == max_resp_len
+    assert [p['response'] for p in parallel_pairs] == [p['response'] for p in pairs]
+
+
+def test_raw_json_missing():
+    args['raw_json'], args['raw_dir'] = 1, 'data/KVR'
+    try:
+        kvr.data_files('')
+        assert False, 'kvret_train_public.json is not in the repo'
+    except FileNotFoundError as e:
+        assert 'kvret_train_public.json' in str(e)
+    finally:
+        args['raw_json'] = 0
+
+
+if __name__=="__main__":
+    test_iter_json_array()
+    test_normalize()
+    test_read_kvret_json()
+    test_raw_json_missing()
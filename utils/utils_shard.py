@@ -0,0 +1,167 @@
+import os
+import json
+import heapq
+import importlib
+from utils.config import *
+from utils.utils_general import Lang, save_vocab, load_vocab
+from utils.utils_cache import lazy_splits, save_pairs, load_pairs, file_hash
+
+'''
+Train split written once into shard files, so that every training process
+parses nothing and loads only its own part of the corpus.
+
+The dialogues of the train file are spread over -ns shards balanced by their
+memory tokens (memory rows x MEM_TOKEN_SIZE summed over the samples of a
+dialogue, the size of the memory the model encodes), largest dialogue first
+into the lightest shard. A dialogue is never split across shards. Every shard
+is a cache entry of utils_cache (shard-00000/) with its manifest
+(shard-00000.json); the directory also holds the vocabulary of the whole train
+split (lang.npy) and manifest.json listing the shards.
+
+With -sd, prepare_data_seq reads the train split from the shards of rank
+-rank out of -world processes (shards rank, rank+world, ...), with the
+vocabulary and max_resp_len of the whole split. -rank and -world default to
+the RANK and WORLD_SIZE set by torchrun.
+
+Command:
+
+python -m utils.utils_shard -ds=kvr -ns=8 -sd=data/shards/kvr
+python -m utils.utils_shard -ds=babi -t=5 -ns=8 -sd=data/shards/babi5
+
+python myTrain.py -ds=kvr -sd=data/shards/kvr -rank=0 -world=4 ...
+
+'''
+
+SHARD_VERSION = 1
+DATASET_MODULES = {
+    'kvr': 'utils.utils_Ent_kvr',
+    'multiwoz': 'utils.utils_Ent_multiwoz_new',
+    'babi': 'utils.utils_Ent_babi'}
+
+
+def memory_tokens(pairs):
+    return sum(len(pair['context_arr']) for pair in pairs) * MEM_TOKEN_SIZE
+
+
+def balance_dialogues(pairs, n_shards):
+    """
+    The samples of pairs grouped into n_shards lists of whole dialogues with close memory
+    token totals. Samples keep their file order within a shard.
+    """
+    dialogues = {}
+    for pair in pairs:
+        dialogues.setdefault(pair['ID'], []).append(pair)
+    order = sorted(dialogues, key=lambda d: (-memory_tokens(dialogues[d]), d))
+    heap = [(0, shard) for shard in range(n_shards)]
+    shards = [[] for _ in range(n_shards)]
+    for d in order:
+        tokens, shard = heapq.heappop(heap)
+        shards[shard].append(d)
+        heapq.heappush(heap, (tokens + memory_tokens(dialogues[d]), shard))
+    return [[pair for d in sorted(shard) for pair in dialogues[d]] for shard in shards]
+
+
+def shard_name(shard):
+    return 'shard-{:05d}'.format(shard)
+
+
+def write_shards(directory, file_name, pairs, n_shards):
+    """Writes the samples of the train file file_name into n_shards shards in directory."""
+    if os.path.exists(os.path.join(directory, 'manifest.json')):
+        raise ValueError("{} already holds shards".format(directory))
+    os.makedirs(directory, exist_ok=True)
+    lang = Lang()
+    for pair in pairs:
+        lang.index_words(pair['context_arr'])
+        lang.index_words(pair['response'], trg=True)
+        lang.index_words(pair['sketch_response'], trg=True)
+    max_resp_len = max([len(pair['response'].split()) for pair in pairs] + [0])
+    save_vocab(directory, lang, max_resp_len)
+
+    source = {'file':file_name, 'sha1':file_hash(file_name)}
+    shards = []
+    for shard, shard_pairs in enumerate(balance_dialogues(pairs, n_shards)):
+        name = shard_name(shard)
+        save_pairs(os.path.join(directory, name), shard_pairs,
+                   max([len(pair['response'].split()) for pair in shard_pairs] + [0]), source['sha1'])
+        manifest = {'shard':shard, 'n_shards':n_shards, 'source':source,
+                    'n_samples':len(shard_pairs), 'memory_tokens':memory_tokens(shard_pairs),
+                    'dialogues':sorted(set(pair['ID'] for pair in shard_pairs))}
+        manifest['n_dialogues'] = len(manifest['dialogues'])
+        with open(os.path.join(directory, name+'.json'), 'w') as f:
+            json.dump(manifest, f)
+        shards.append({'name':name, 'n_samples':manifest['n_samples'], 'memory_tokens':manifest['memory_tokens']})
+
+    manifest = {'version':SHARD_VERSION, 'dataset':args['dataset'], 'task':args['task'],
+                'mem_token_size':MEM_TOKEN_SIZE, 'source':source, 'n_samples':len(pairs),
+                'max_resp_len':max_resp_len, 'vocab_size':lang.n_words, 'shards':shards}
+    # manifest.json is written last: a directory without it holds no usable shards
+    with open(os.path.join(directory, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=1)
+    return manifest
+
+
+def read_manifest(directory):
+    with open(os.path.join(directory, 'manifest.json')) as f:
+        manifest = json.load(f)
+    if manifest['version'] != SHARD_VERSION:
+        raise ValueError("{} holds shards of version {}, not {}".format(directory, manifest['version'], SHARD_VERSION))
+    if [manifest['dataset'], manifest['task'], manifest['mem_token_size']] != [args['dataset'], args['task'], MEM_TOKEN_SIZE]:
+        raise ValueError("{} holds shards of -ds={} -t={}".format(directory, manifest['dataset'], manifest['task']))
+    return manifest
+
+
+def rank_shards(n_shards, rank, world):
+    """The shards read by process rank out of world."""
+    if not 0 <= rank < world:
+        raise ValueError("rank {} is not in a world of size {}".format(rank, world))
+    if world > n_shards:
+        raise ValueError("{} shards cannot feed {} processes".format(n_shards, world))
+    return list(range(rank, n_shards, world))
+
+
+class ShardSplit:
+    """
+    The train samples of process rank out of world, from the shards in directory, like a
+    LazySplit. max_resp_len and vocab are those of the whole train split.
+    """
+    def __init__(self, directory, rank, world):
+        self.directory = directory
+        manifest = read_manifest(directory)
+        self.file_name = manifest['source']['file']
+        self.shards = rank_shards(len(manifest['shards']), rank, world)
+        self.max_resp_len = manifest['max_resp_len']
+        self.n_samples = sum(manifest['shards'][shard]['n_samples'] for shard in self.shards)
+        self.vocab, _ = load_vocab(directory)
+
+    def pairs(self):
+        print("Loading shards {} of {}".format(self.shards, self.directory))
+        pairs = []
+        for shard in self.shards:
+            pairs += load_pairs(os.path.join(self.directory, shard_name(shard)))[0]
+        return pairs
+
+
+def train_splits(read_langs, file_names, deps, *read_args):
+    """
+    lazy_splits over the train file and the other splits of a dataset, the train split being
+    the ShardSplit of -rank in -sd when it is given.
+    """
+    if not args['shard_dir']:
+        return lazy_splits(read_langs, file_names, deps, *read_args)
+    split_train = ShardSplit(args['shard_dir'], args['rank'], args['world'])
+    if os.path.basename(split_train.file_name) != os.path.basename(file_names[0]):
+        print("[WARNING] {} holds shards of {}, not {}".format(args['shard_dir'], split_train.file_name, file_names[0]))
+    return [split_train] + lazy_splits(read_langs, file_names[1:], deps, *read_args)
+
+
+if __name__ == "__main__":
+    if args['dataset'] not in DATASET_MODULES or not args['shard_dir']:
+        print("[ERROR] You need to provide the --dataset and --shard_dir information")
+        exit(1)
+    module = importlib.import_module(DATASET_MODULES[args['dataset']])
+    files, deps, read_args = module.data_files(args['task'])
+    split_train, = lazy_splits(module.read_langs, [files['train']], deps, *read_args)
+    manifest = write_shards(args['shard_dir'], files['train'], split_train.pairs(), args['n_shards'])
+    for shard in manifest['shards']:
+        print("{}: {} samples, {} memory tokens".format(shard['name'], shard['n_samples'], shard['memory_tokens']))
@@ -0,0 +1,54 @@
+import sys
+sys.argv = sys.argv[:1] + ['-ds=kvr']  # utils.config parses the command line on import
+
+import tempfile
+from utils.config import *
+import utils.utils_Ent_kvr as kvr
+from utils.utils_general import Lang
+from utils.utils_cache import read_langs_cached
+from utils.utils_shard import write_shards, ShardSplit, memory_tokens
+
+'''
+Shards hold every dialogue of the source file once, whole, with memory token
+totals within one dialogue of each other, and a rank reads back exactly the
+samples of its shards with the vocabulary of the whole file.
+
+Command:
+
+python -m pytest utils/utils_shard_test.py
+
+'''
+
+FILE = 'data/KVR/dev_modified.txt'
+
+
+def test_shards():
+    pairs, _ = read_langs_cached(kvr.read_langs, FILE, ['data/KVR/kvret_entities.json'])
+    with tempfile.TemporaryDirectory() as directory:
+        manifest = write_shards(directory, FILE, pairs, 3)
+
+        tokens = [shard['memory_tokens'] for shard in manifest['shards']]
+        largest = max(memory_tokens([p for p in pairs if p['ID'] == d]) for d in set(p['ID'] for p in pairs))
+        assert sum(tokens) == memory_tokens(pairs) and max(tokens) - min(tokens) <= largest
+
+        lang = Lang()
+        for pair in pairs:
+            lang.index_words(pair['context_arr'])
+            lang.index_words(pair['response'], trg=True)
+            lang.index_words(pair['sketch_response'], trg=True)
+
+        read = []
+        for rank in range(2):
+            split = ShardSplit(directory, rank, 2)
+            assert split.vocab.word2index == lang.word2index
+            shard_pairs = split.pairs()
+            assert len(shard_pairs) == split.n_samples
+            read += shard_pairs
+        assert sorted((p['ID'], p['id']) for p in read) == sorted((p['ID'], p['id']) for p in pairs)
+        key = lambda p: (p['ID'], p['id'])
+        for a, b in zip(sorted(read, key=key), sorted(pairs, key=key)):
+            assert a['response'] == b['response'] and list(a['context_arr']) == list(b['context_arr'])
+
+
+if __name__=="__main__":
+    test_shards()
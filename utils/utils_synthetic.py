@@ -0,0 +1,122 @@
+import math
+import random
+from utils.config import *
+from utils.utils_entity import get_entity_index
+
+'''
+Synthetic dialogues in the text formats of the KVR, MultiWOZ and bAbI files,
+for measuring how parsing, training and inference scale with the number of
+dialogues, turns and KB rows far beyond the bundled corpora.
+
+Every dialogue has -gk KB rows (subject, slot type, value) and -gt turns of
+3 to 12 words. Words are entities with probability -ge, the others are drawn
+from a filler vocabulary of -gv words. The entities of a system response are
+values of the dialogue KB (restaurant names for bAbI, whose KB rows follow the
+first turn), so the local pointer always has a target. All values come from
+the entity index of the dataset, so generate_template finds their type like
+in the real files.
+
+KVR files are found by prepare_data_seq through the -t prefix of their name:
+writing data/KVR/syn_{train,dev,test}_modified.txt and training with -t=syn_
+trains on synthetic data.
+
+Command:
+
+python -m utils.utils_synthetic -ds=kvr -gd=1000 -gt=5 -gk=10000 -go=data/KVR/syn_train_modified.txt
+python -m utils.utils_synthetic -ds=babi -gd=200 -gk=500 -ge=0.3 -go=/tmp/babi-syn.txt
+
+'''
+
+DOMAINS = {
+    'kvr': ['navigate', 'schedule', 'weather'],
+    'multiwoz': ['restaurant', 'hotel', 'attraction', 'train'],
+    'babi': [None]}
+SUBJECT_TYPES = {'kvr': 'poi', 'multiwoz': 'name', 'babi': 'R_restaurant'}
+
+
+def entity_pools(dataset):
+    """Single-token entity values of dataset by slot type."""
+    index = get_entity_index(dataset)
+    pools = {}
+    for value, slot_type in index.type_of.items():
+        if ' ' not in value:
+            pools.setdefault(slot_type, []).append(value)
+    return pools
+
+
+class SyntheticDialogues:
+    """Random dialogues of dataset, the same for the same seed."""
+    def __init__(self, dataset, n_turns, n_kb, n_vocab, entity_density, seed=0):
+        self.dataset = dataset
+        self.n_turns = n_turns
+        self.n_kb = n_kb
+        self.entity_density = entity_density
+        self.rng = random.Random(seed)
+        self.words = ['w{}'.format(i) for i in range(n_vocab)]
+        self.pools = entity_pools(dataset)
+        self.subjects = self.pools[SUBJECT_TYPES[dataset]]
+        self.slot_types = sorted(t for t in self.pools if t != SUBJECT_TYPES[dataset])
+        # user turns mention a few values of every type, not only those of the dialogue KB
+        self.user_values = [value for slot_type in sorted(self.pools) for value in self.pools[slot_type][:50]]
+
+    def kb_rows(self):
+        n_subjects = int(math.ceil(self.n_kb / float(len(self.slot_types))))
+        rows = []
+        for _ in range(n_subjects):
+            subject = self.rng.choice(self.subjects)
+            for slot_type in self.rng.sample(self.slot_types, len(self.slot_types)):
+                rows.append([subject, slot_type, self.rng.choice(self.pools[slot_type])])
+        return rows[:self.n_kb]
+
+    def utterance(self, values):
+        """3 to 12 words, each an entity of values with probability entity_density."""
+        words = []
+        for _ in range(self.rng.randint(3, 12)):
+            if values and self.rng.random() < self.entity_density:
+                words.append(self.rng.choice(values))
+            else:
+                words.append(self.rng.choice(self.words))
+        return words
+
+    def lines(self):
+        """The lines of one dialogue, without the blank line closing it."""
+        domain = self.rng.choice(DOMAINS[self.dataset])
+        rows = self.kb_rows()
+        # the bAbI local pointer finds KB rows by their restaurant, the others by their value
+        kb_values = [row[0] if self.dataset == 'babi' else row[-1] for row in rows]
+        turns = []
+        for turn in range(self.n_turns):
+            u = self.utterance(self.user_values)
+            # the bAbI KB rows only follow the first turn, its response cannot point to them
+            r = self.utterance([] if self.dataset == 'babi' and turn == 0 else kb_values)
+            gold_ent = []
+            for word in r:
+                if word in kb_values and word not in gold_ent:
+                    gold_ent.append(word)
+            turns.append((' '.join(u), ' '.join(r), gold_ent))
+
+        if self.dataset == 'babi':
+            # numbered KB rows follow the first turn, like the api_call results of the real files
+            lines = ['1 {}\t{}'.format(turns[0][0], turns[0][1])]
+            lines += ['{} {}'.format(len(lines) + i + 1, ' '.join(row)) for i, row in enumerate(rows)]
+            lines += ['{} {}\t{}'.format(len(lines) + i + 1, u, r) for i, (u, r, _) in enumerate(turns[1:])]
+            return lines
+        lines = ['#{}#'.format(domain)] + ['0 ' + ' '.join(row) for row in rows]
+        lines += ['{} {}\t{}\t{}'.format(nid, u, r, gold_ent) for nid, (u, r, gold_ent) in enumerate(turns, 1)]
+        return lines
+
+
+def write_synthetic(file_name, n_dialogues, generator):
+    with open(file_name, 'w') as f:
+        for _ in range(n_dialogues):
+            f.write('\n'.join(generator.lines()) + '\n\n')
+
+
+if __name__ == "__main__":
+    if args['dataset'] not in DOMAINS or not args['gen_out']:
+        print("[ERROR] You need to provide the --dataset and --gen_out information")
+        exit(1)
+    generator = SyntheticDialogues(args['dataset'], args['gen_turns'], args['gen_kb_rows'], args['gen_vocab'],
+                                   args['gen_entity_density'], seed=args['sample_seed'])
+    write_synthetic(args['gen_out'], args['gen_dialogues'], generator)
+    print("Wrote {} dialogues to {}".format(args['gen_dialogues'], args['gen_out']))
@@ -0,0 +1,64 @@
+import sys
+sys.argv = sys.argv[:1] + ['-ds=kvr']  # utils.config parses the command line on import
+
+import os
+import tempfile
+from utils.config import *
+import utils.utils_Ent_kvr as kvr
+import utils.utils_Ent_multiwoz_new as multiwoz
+import utils.utils_Ent_babi as babi
+from utils.utils_entity import get_babi_index
+from utils.utils_synthetic import SyntheticDialogues, write_synthetic
+
+'''
+Synthetic KVR, MultiWOZ and bAbI files parse with the read_langs of their
+dataset into the requested number of samples and KB rows, every gold entity
+of a response has a pointer target and a slot type in the sketch, and the
+same seed writes the same file.
+
+Command:
+
+python -m pytest utils/utils_synthetic_test.py
+
+'''
+
+
+def check_synthetic(dataset, read_langs, read_args=()):
+    with tempfile.TemporaryDirectory() as directory:
+        files = [os.path.join(directory, name) for name in ['a.txt', 'b.txt']]
+        for file_name in files:
+            write_synthetic(file_name, 7, SyntheticDialogues(dataset, 4, 120, 50, 0.3, seed=3))
+        assert open(files[0]).read() == open(files[1]).read()
+        pairs, _ = read_langs(files[0], *read_args)
+
+    assert len(pairs) == 7 * 4
+    # the KB rows of bAbI follow the first turn, like the api_call results
+    first_turn_kb = 0 if dataset == 'babi' else 120
+    assert [pair['kb_arr'].n_kb for pair in pairs] == [first_turn_kb, 120, 120, 120] * 7
+    n_entities = 0
+    for pair in pairs:
+        sketch = pair['sketch_response'].split()
+        for i, word in enumerate(pair['response'].split()):
+            if word in pair['ent_index']:
+                assert pair['ptr_index'][i] < len(pair['context_arr']) - 1
+                assert sketch[i].startswith('@')
+                n_entities += 1
+    assert n_entities > 0
+
+
+def test_synthetic_kvr():
+    check_synthetic('kvr', kvr.read_langs)
+
+
+def test_synthetic_multiwoz():
+    check_synthetic('multiwoz', multiwoz.read_langs)
+
+
+def test_synthetic_babi():
+    check_synthetic('babi', babi.read_langs, (get_babi_index(5),))
+
+
+if __name__=="__main__":
+    test_synthetic_kvr()
+    test_synthetic_multiwoz()
+    test_synthetic_babi()
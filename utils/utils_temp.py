@@ -13,6 +13,7 @@ from torch.autograd import Variable
 from torch import optim
 import torch.nn.functional as F
 from utils.config import *
+from utils.utils_entity import get_babi_index
 import logging 
 import datetime
 
@@ -321,7 +322,7 @@ def get_type_dict(kb_path, dstc2=False):
     For each type, the corresponding type word is added to the candidate representation if a word is found that appears 
     1) as a KB entity of that type, 
     """
-    type_dict = {'R_restaurant':[]}
+    type_dict = {'R_restaurant':{}} # ordered sets as dict keys
 
     kb_path_temp = kb_path
     fd = open(kb_path_temp,'r') 
@@ -338,13 +339,9 @@ def get_type_dict(kb_path, dstc2=False):
             entity = x[2]
             entity_value = line.split('\t')[1].replace('\n','')
     
-        if rest_name not in type_dict['R_restaurant']:
-            type_dict['R_restaurant'].append(rest_name)
-        if entity not in type_dict.keys():
-            type_dict[entity] = []
-        if entity_value not in type_dict[entity]:
-            type_dict[entity].append(entity_value)
-    return type_dict
+        type_dict['R_restaurant'].setdefault(rest_name)
+        type_dict.setdefault(entity, {}).setdefault(entity_value)
+    return dict((key, list(values)) for key, values in type_dict.items())
 
 def entityList(kb_path, task_id):
     type_dict = get_type_dict(kb_path, dstc2=(task_id==6))
@@ -373,20 +370,18 @@ def load_candidates(task_id, candidates_f):
             idx2candid[i] = line.strip().split(' ',1)[1]
     return candidates, candid2idx, idx2candid
 
-def candid2DL(candid_path, kb_path, task_id):
-    type_dict = get_type_dict(kb_path, dstc2=(task_id==6))
-    ent_list = entityList(kb_path,int(task_id))
+def candid2DL(candid_path, task_id):
+    kb_index = get_babi_index(task_id)
     candidates, _, _ = load_candidates(task_id=task_id, candidates_f=candid_path)
     candid_all = []  
     candid2candDL = {}
     for index, cand in enumerate(candidates):
         cand_DL = [ x for x in cand]
         for index, word in enumerate(cand_DL):
-            if word in ent_list:
-                for type_name in type_dict:
-                    if word in type_dict[type_name] and type_name != 'R_rating':
-                        cand_DL[index] = type_name
-                        break
+            for type_name in kb_index.types(word):
+                if type_name != 'R_rating':
+                    cand_DL[index] = type_name
+                    break
         cand_DL = ' '.join(cand_DL)
         candid_all.append(cand_DL)
         candid2candDL[' '.join(cand)] = cand_DL
@@ -408,16 +403,14 @@ def prepare_data_seq(task, batch_size=100):
     if (int(task) != 6):
         file_test_OOV = 'data/dialog-bAbI-tasks/dialog-babi-task{}tst-OOV.txt'.format(task)
         candid_file_path = 'data/dialog-bAbI-tasks/dialog-babi-candidates.txt'
-        kb_path = 'data/dialog-bAbI-tasks/dialog-babi-kb-all.txt'
     else:
         candid_file_path = 'data/dialog-bAbI-tasks/dialog-babi-task6-dstc2-candidates.txt'
-        kb_path = 'data/dialog-bAbI-tasks/dialog-babi-task6-dstc2-kb.txt'
     
     query2idx = {'UNK':0, 'R_restaurant':7, 'R_cuisine':1, 'R_location':2, 'R_price':3, 'R_number':4, 
                 'R_phone':5, 'R_address':6}
 
-    ent = entityList(kb_path,int(task))
-    cand2DLidx, idx2candDL = candid2DL(candid_file_path, kb_path, int(task))
+    ent = get_babi_index(task)
+    cand2DLidx, idx2candDL = candid2DL(candid_file_path, int(task))
 
     pair_train, max_len_train = read_langs(file_train, ent, cand2DLidx, idx2candDL, max_line=None)
     pair_dev,max_len_dev = read_langs(file_dev, ent, cand2DLidx, idx2candDL, max_line=None)
@@ -1,5 +1,6 @@
 import tensorflow as tf
 from utils.config import *
+from utils.utils_general import token_budget_buckets
 
 
 def gen_samples(data, length):
@@ -116,55 +117,69 @@ def get_seq(data_info, batch_size, drop_remainder):
                                                   )
                                    )
     print(len(data_info))
-    ds_series_batch = ds_series.shuffle(len(data_info)).padded_batch(batch_size, padded_shapes=([None, MEM_TOKEN_SIZE],  # context_arr
-                                                                              [None,],  # response
-                                                                              [None,],  # sketch_response
-                                                                              [None, MEM_TOKEN_SIZE],  # conv_arr
-                                                                              [None,],  # ptr_index
-                                                                              [None,],  # selector_index
-                                                                              [None, MEM_TOKEN_SIZE],  # kb_arr
-                                                                              [None, MEM_TOKEN_SIZE],  # context_arr_plain
-                                                                              [None,],  # response_plain
-                                                                              [None, MEM_TOKEN_SIZE],  # kb_arr_plain
-                                                                              [],  # context_arr_lengths
-                                                                              [],  # response_lengths
-                                                                              [],  # conv_arr_lengths
-                                                                              [],  # kb_arr_lengths
-                                                                              [None,],  # ent_index
-                                                                              [],  # ent_index_lengths
-                                                                              [None,],  # ent_idx_cal
-                                                                              [None,],  # ent_idx_nav
-                                                                              [None,],  # ent_idx_wet
-                                                                              [],  # ent_idx_cal_lengths
-                                                                              [],  # ent_idx_nav_lengths
-                                                                              [],  # ent_idx_wet_lengths
-                                                                              []  # ID
-                                                                              ),
-                                                   padding_values=(PAD_token,  # context_arr
-                                                                   PAD_token,  # response
-                                                                   PAD_token,  # sketch_response
-                                                                   PAD_token,  # conv_arr
-                                                                   PAD_token,  # ptr_index
-                                                                   0,  # selector_index
-                                                                   PAD_token,  # kb_arr
-                                                                   'PAD',  # context_arr_plain
-                                                                   'PAD',  # response_plain
-                                                                   'PAD',   # kb_arr_plain
-                                                                   0,  # context_arr_lengths
-                                                                   0,  # response_lengths
-                                                                   0,  # conv_arr_lengths
-                                                                   0,  # kb_arr_lengths
-                                                                   'PAD',  # ent_index
-                                                                   0,  # ent_index_lengths
-                                                                   'PAD',  # ent_idx_cal
-                                                                   'PAD',  # ent_idx_nav
-                                                                   'PAD',  # ent_idx_wet
-                                                                   0,  # ent_idx_cal_lengths
-                                                                   0,  # ent_idx_nav_lengths
-                                                                   0,  # ent_idx_wet_lengths
-                                                                   0  # ID
-                                                                   ),
-                                                    drop_remainder=drop_remainder
-                                                   )
+    padded_shapes = ([None, MEM_TOKEN_SIZE],  # context_arr
+                     [None,],  # response
+                     [None,],  # sketch_response
+                     [None, MEM_TOKEN_SIZE],  # conv_arr
+                     [None,],  # ptr_index
+                     [None,],  # selector_index
+                     [None, MEM_TOKEN_SIZE],  # kb_arr
+                     [None, MEM_TOKEN_SIZE],  # context_arr_plain
+                     [None,],  # response_plain
+                     [None, MEM_TOKEN_SIZE],  # kb_arr_plain
+                     [],  # context_arr_lengths
+                     [],  # response_lengths
+                     [],  # conv_arr_lengths
+                     [],  # kb_arr_lengths
+                     [None,],  # ent_index
+                     [],  # ent_index_lengths
+                     [None,],  # ent_idx_cal
+                     [None,],  # ent_idx_nav
+                     [None,],  # ent_idx_wet
+                     [],  # ent_idx_cal_lengths
+                     [],  # ent_idx_nav_lengths
+                     [],  # ent_idx_wet_lengths
+                     []  # ID
+                     )
+    padding_values = (PAD_token,  # context_arr
+                      PAD_token,  # response
+                      PAD_token,  # sketch_response
+                      PAD_token,  # conv_arr
+                      PAD_token,  # ptr_index
+                      0,  # selector_index
+                      PAD_token,  # kb_arr
+                      'PAD',  # context_arr_plain
+                      'PAD',  # response_plain
+                      'PAD',   # kb_arr_plain
+                      0,  # context_arr_lengths
+                      0,  # response_lengths
+                      0,  # conv_arr_lengths
+                      0,  # kb_arr_lengths
+                      'PAD',  # ent_index
+                      0,  # ent_index_lengths
+                      'PAD',  # ent_idx_cal
+                      'PAD',  # ent_idx_nav
+                      'PAD',  # ent_idx_wet
+                      0,  # ent_idx_cal_lengths
+                      0,  # ent_idx_nav_lengths
+                      0,  # ent_idx_wet_lengths
+                      0  # ID
+                      )
+    ds_series = ds_series.shuffle(len(data_info))
+    if args['token_budget'] > 0:
+        # batch size per context length bucket from the token budget instead of batch_size
+        boundaries, batch_sizes = token_budget_buckets([len(d['context_arr']) for d in data_info],
+                                                       args['token_budget'], max(args['buckets'], 1))
+        ds_series_batch = ds_series.bucket_by_sequence_length(lambda *sample: tf.shape(sample[0])[0],
+                                                              boundaries,
+                                                              batch_sizes,
+                                                              padded_shapes=padded_shapes,
+                                                              padding_values=padding_values,
+                                                              drop_remainder=drop_remainder)
+    else:
+        ds_series_batch = ds_series.padded_batch(batch_size,
+                                                 padded_shapes=padded_shapes,
+                                                 padding_values=padding_values,
+                                                 drop_remainder=drop_remainder)
     ds_series_batch = ds_series_batch.prefetch(1)
     return ds_series_batch
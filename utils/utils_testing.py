@@ -0,0 +1,105 @@
+import importlib
+import torch
+from utils.config import *
+from utils.utils_general import Lang, get_seq, _cuda
+from utils.utils_cache import read_langs_cached
+from utils.utils_shard import DATASET_MODULES
+
+'''
+Reference implementations and data shared by the tests and the benchmarks:
+the per-sample loop_collate that Dataset.collate_fn replaced, the vocabulary
+and Dataset of a dev split, and the batch comparison of the two collates.
+'''
+
+DEV_FILES = {
+    'kvr': 'data/KVR/dev_modified.txt',
+    'multiwoz': 'data/multiwoz/valid_modified.txt',
+    'babi': 'data/dialog-bAbI-tasks/dialog-babi-task{}dev.txt'}
+
+
+def loop_collate(data):
+    """The collate_fn that padded every sample with Python loops."""
+    def merge(sequences,story_dim):
+        lengths = [len(seq) for seq in sequences]
+        max_len = 1 if max(lengths)==0 else max(lengths)
+        if (story_dim):
+            padded_seqs = torch.ones(len(sequences), max_len, MEM_TOKEN_SIZE).long()
+            for i, seq in enumerate(sequences):
+                end = lengths[i]
+                if len(seq) != 0:
+                    padded_seqs[i,:end,:] = seq[:end]
+        else:
+            padded_seqs = torch.ones(len(sequences), max_len).long()
+            for i, seq in enumerate(sequences):
+                end = lengths[i]
+                padded_seqs[i, :end] = seq[:end]
+        return padded_seqs, lengths
+
+    def merge_index(sequences):
+        lengths = [len(seq) for seq in sequences]
+        padded_seqs = torch.zeros(len(sequences), max(lengths)).float()
+        for i, seq in enumerate(sequences):
+            end = lengths[i]
+            padded_seqs[i, :end] = seq[:end]
+        return padded_seqs, lengths
+
+    data.sort(key=lambda x: len(x['conv_arr']), reverse=True)
+    item_info = {}
+    for key in data[0].keys():
+        item_info[key] = [d[key] for d in data]
+
+    context_arr, context_arr_lengths = merge(item_info['context_arr'], True)
+    response, response_lengths = merge(item_info['response'], False)
+    selector_index, _ = merge_index(item_info['selector_index'])
+    ptr_index, _ = merge(item_info['ptr_index'], False)
+    conv_arr, conv_arr_lengths = merge(item_info['conv_arr'], True)
+    sketch_response, _ = merge(item_info['sketch_response'], False)
+    kb_arr, kb_arr_lengths = merge(item_info['kb_arr'], True)
+
+    context_arr = _cuda(context_arr.contiguous())
+    response = _cuda(response.contiguous())
+    selector_index = _cuda(selector_index.contiguous())
+    ptr_index = _cuda(ptr_index.contiguous())
+    conv_arr = _cuda(conv_arr.transpose(0,1).contiguous())
+    sketch_response = _cuda(sketch_response.contiguous())
+    if(len(list(kb_arr.size()))>1): kb_arr = _cuda(kb_arr.transpose(0,1).contiguous())
+
+    data_info = {}
+    for k in item_info.keys():
+        try:
+            data_info[k] = locals()[k]
+        except:
+            data_info[k] = item_info[k]
+    data_info['context_arr_lengths'] = context_arr_lengths
+    data_info['response_lengths'] = response_lengths
+    data_info['conv_arr_lengths'] = conv_arr_lengths
+    data_info['kb_arr_lengths'] = kb_arr_lengths
+    return data_info
+
+
+def build_lang(pairs):
+    """The vocabulary of pairs, indexed like prepare_data_seq does for the train split."""
+    lang = Lang()
+    for pair in pairs:
+        lang.index_words(pair['context_arr'])
+        lang.index_words(pair['response'], trg=True)
+        lang.index_words(pair['sketch_response'], trg=True)
+    return lang
+
+
+def load_dataset(batch_size):
+    """The Dataset of the dev split of -ds, encoded with the vocabulary of its samples."""
+    module = importlib.import_module(DATASET_MODULES[args['dataset']])
+    task = args['task'] or ('5' if args['dataset'] == 'babi' else '')
+    _, deps, read_args = module.data_files(task)
+    pairs, _ = read_langs_cached(module.read_langs, DEV_FILES[args['dataset']].format(task), deps, *read_args)
+    return get_seq(pairs, build_lang(pairs), batch_size, False).dataset
+
+
+def assert_same_batch(loop, vectorized):
+    """Every field of the loop_collate batch loop is in the collate_fn batch vectorized, equal."""
+    for k, v in loop.items():
+        if torch.is_tensor(v):
+            assert v.dtype == vectorized[k].dtype and torch.equal(v, vectorized[k]), k
+        else:
+            assert list(v) == list(vectorized[k]), k